@@ -1,10 +1,29 @@
+import time
+# Taken before the other imports so the startup report covers them.
+STARTUP_STARTED = time.perf_counter()
 import os
+import sys
 import json
+import asyncio
+import argparse
+import re
+import hashlib
+import gzip
+import sqlite3
+import tempfile
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox , simpledialog
 import threading
+import queue
+import socket
+from collections import deque
+from collections import OrderedDict
+import atexit
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import webbrowser
-from langchain_ollama import OllamaLLM
+import urllib.error
+import urllib.parse
+import urllib.request
 import traceback
 from datetime import datetime
 
@@ -12,35 +31,2046 @@ CONVERSATION_DIR = "conversations"
 if not os.path.exists(CONVERSATION_DIR):
     os.makedirs(CONVERSATION_DIR)   
 
+# Context windows to use instead of the one Ollama reports for a model.
 MODEL_CONTEXT_WINDOWS = {
     "qwen3:4b": 40000,
     "qwen2.5-coder:latest":32000,
     "gemma3:4b": 128000,
 }
+# Models offered before the installed ones have been read from the Ollama servers.
+FALLBACK_MODELS = ["qwen2.5-coder:latest", "qwen3:4b", "gemma3:4b"]
+
+OLLAMA_BASE_URL = "http://localhost:11434"
+# Ollama servers to spread requests over. Each request goes to the healthy server that has
+# the model with the shortest expected wait: (requests in flight + 1) x its recent time to
+# first token, plus MODEL_LOAD_SECONDS x (models already loaded + 1) when the model is not
+# loaded there yet, so the main developer and the helpers end up on different hosts.
+OLLAMA_ENDPOINTS = [OLLAMA_BASE_URL]
+ENDPOINT_CHECK_INTERVAL = 30
+ENDPOINT_DEFAULT_LATENCY = 1.0
+ENDPOINT_LATENCY_SMOOTHING = 0.3
+MODEL_LOAD_SECONDS = 5.0
+# How long Ollama keeps a model in memory after its last request. Selected models are
+# loaded in the background at startup and whenever a model selection changes.
+MODEL_KEEP_ALIVE = "30m"
+
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Ollama options for each call. Entries are applied in order: "*" for every call, then the
+# role, then the model, then a (model, role) pair, later ones overriding earlier ones. A
+# num_thread of None leaves the choice to Ollama.
+GENERATION_PROFILES = {
+    "*": {"num_predict": 2048, "temperature": 0.7, "num_thread": None},
+    "Main Developer": {"temperature": 0.4},
+    "Helper 1": {"temperature": 0.8},
+    "Helper 2": {"temperature": 0.8},
+    "Summary": {"temperature": 0.2, "num_predict": 1024},
+}
+
+# Unless a profile sets num_ctx, it is sized to the prompt plus num_predict, capped by the
+# model's context window and rounded up to one of NUM_CTX_STEPS. A model keeps its size until
+# a prompt needs a larger one, or until one NUM_CTX_SHRINK_FACTOR times smaller would do,
+# because Ollama reloads the model whenever num_ctx changes.
+NUM_CTX_STEPS = (4096, 8192, 16384, 32768, 65536, 131072)
+NUM_CTX_INITIAL = 8192
+NUM_CTX_SHRINK_FACTOR = 4
+NUM_CTX_PROMPT_MARGIN = 1.1
+
+# Share of the smallest selected model's context window that conversation history may take
+# up in a prompt. When it is exceeded, the oldest turns are folded into a rolling summary
+# until the verbatim turns fit in HISTORY_KEEP_RATIO of the budget again, so a summary is
+# only generated every few turns rather than on every one. The folded turns go into the summary
+# in batches of at most SUMMARY_CHUNK_TOKENS, each batch updating the summary of the ones before.
+HISTORY_BUDGET_RATIO = 0.5
+HISTORY_KEEP_RATIO = 0.6
+SUMMARY_MAX_WORDS = 300
+SUMMARY_ENTRY_CHARS = 4000
+
+CACHE_DIR = os.path.join(CONVERSATION_DIR, ".cache")
+
+# Helper answers that push the improved prompt over budget are condensed chunk by chunk
+# (chunks of at most SUMMARY_CHUNK_TOKENS, split between code blocks and paragraphs) and the
+# partial summaries are merged. Results are memoized on disk by content hash.
+SUMMARY_CHUNK_TOKENS = 4000
+SUMMARY_CACHE_SIZE = 500
+
+# Installed models and their context windows, read from /api/tags and /api/show, are kept in
+# MODEL_CATALOG_PATH and fetched again in the background once older than MODEL_CATALOG_TTL seconds.
+MODEL_CATALOG_PATH = os.path.join(CACHE_DIR, "models.json")
+MODEL_CATALOG_TTL = 3600
+
+# Model responses are cached on disk keyed by model, generation options and prompt.
+# LLM_CACHE_MODE is "off", "read-write", or "replay", which only answers from the cache and
+# raises CacheMissError otherwise so runs are deterministic and work offline.
+LLM_CACHE_MODE = "read-write"
+LLM_CACHE_DIR = os.path.join(CACHE_DIR, "llm")
+LLM_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# num_ctx is left out: it is sized to fit the prompt, so it does not change the answer.
+LLM_CACHE_OPTIONS = ("reasoning", "mirostat", "mirostat_eta", "mirostat_tau", "num_predict",
+                     "repeat_last_n", "repeat_penalty", "temperature", "seed", "stop", "tfs_z",
+                     "top_k", "top_p", "format")
+
+# Number of recent model calls kept for the metrics export; totals cover the whole session.
+METRICS_LOG_SIZE = 1000
+
+# Hugging Face tokenizers matching the Ollama models. When `transformers` is installed and
+# the tokenizer can be loaded, token counts are exact; otherwise a heuristic is used.
+MODEL_TOKENIZERS = {
+    "qwen3:4b": "Qwen/Qwen3-4B",
+    "qwen2.5-coder:latest": "Qwen/Qwen2.5-Coder-7B-Instruct",
+    "gemma3:4b": "google/gemma-3-4b-it",
+}
+# Token counts of recent messages, kept in memory per counter so a history is only tokenized
+# once no matter how many prompts it ends up in.
+TOKEN_COUNT_CACHE_SIZE = 20000
+
+# Show model output in the chat as it is generated instead of waiting for the full answer.
+STREAM_RESPONSES = True
+
+# Print how long startup took: imports, building the window, first paint, and the Ollama
+# clients being ready to send (LangChain is imported in the background after the first paint).
+STARTUP_REPORT = False
+STARTUP_PHASES = ("import", "ui_build", "first_paint", "ready_to_send")
+
+ROLE_TAGS = {
+    "Programmer": ("user", "You"),
+    "Main Developer": ("main_dev", "Main Developer"),
+    "Helper 1": ("helper1", "Helper 1"),
+    "Helper 2": ("helper2", "Helper 2"),
+    "System": ("system", "System"),
+}
+
+# Conversations export as plain text (.txt), Markdown (.md) or JSON Lines (.jsonl), gzipped when
+# the file name ends in .gz. "Export All" writes EXPORT_WORKERS conversations at a time.
+EXPORT_FORMATS = {".txt": "text", ".md": "markdown", ".jsonl": "jsonl"}
+EXPORT_WORKERS = 4
+
+# Fenced code in messages is tokenized with Pygments (when installed) on a worker thread. The
+# resulting tag spans are cached per content hash and applied HIGHLIGHT_SPANS_PER_BATCH at a
+# time, so long answers never block the window.
+HIGHLIGHT_CACHE_SIZE = 500
+HIGHLIGHT_SPANS_PER_BATCH = 2000
+# Colors per Pygments token type; a token uses the closest listed parent type.
+HIGHLIGHT_COLORS = {
+    "Keyword": "#8e44ad",
+    "Name.Builtin": "#0984e3",
+    "Name.Function": "#0652dd",
+    "Name.Class": "#0652dd",
+    "Name.Decorator": "#e17055",
+    "Literal.String": "#00a35c",
+    "Literal.Number": "#d35400",
+    "Comment": "#95a5a6",
+    "Operator.Word": "#8e44ad",
+}
+
+# Events posted by worker threads are applied to the window in one batch every
+# RENDER_DELAY_MS, at most UI_EVENTS_PER_BATCH at a time; redraws requested in between
+# are merged into a single render pass.
+RENDER_DELAY_MS = 30
+UI_EVENTS_PER_BATCH = 500
+
+# Conversations are kept as a JSON snapshot (<name>.json) plus an append-only journal
+# (<name>.jsonl) of the messages added since the last compaction.
+JOURNAL_COMPACT_ENTRIES = 200
+JOURNAL_FSYNC_INTERVAL = 2.0
+
+# "json" stores each conversation as files in CONVERSATION_DIR, "sqlite" keeps them all in
+# CONVERSATION_DB with a full-text index over message content.
+STORAGE_BACKEND = "json"
+CONVERSATION_DB = os.path.join(CONVERSATION_DIR, "conversations.db")
+SEARCH_RESULT_LIMIT = 100
+
+# Name, message count, size, last change and first request of every conversation, kept in
+# CONVERSATION_INDEX_PATH so the sidebar does not open the conversations to list them. It is
+# updated on every save and written at most every CONVERSATION_INDEX_FLUSH_INTERVAL seconds.
+CONVERSATION_INDEX_PATH = os.path.join(CACHE_DIR, "index.json")
+CONVERSATION_INDEX_FLUSH_INTERVAL = 2.0
+CONVERSATION_PAGE_SIZE = 100
+PREVIEW_CHARS = 80
+# Histories of recently opened conversations kept in memory, so switching back is instant.
+HISTORY_CACHE_SIZE = 8
+
+# An open conversation keeps its last HISTORY_WINDOW_SIZE messages (and any its summary does not
+# cover yet) in memory; older ones are read back from storage when needed. The chat window shows
+# the same tail and pages in HISTORY_PAGE_SIZE older messages whenever it is scrolled to the top;
+# once it holds more than HISTORY_WINDOW_SIZE + HISTORY_PAGE_SIZE, messages at the far end are
+# dropped and paged back in if the view returns there.
+HISTORY_WINDOW_SIZE = 100
+HISTORY_PAGE_SIZE = 50
+# Messages longer than COLLAPSE_CHARS are shown as their first COLLAPSE_PREVIEW_CHARS until clicked.
+COLLAPSE_CHARS = 4000
+COLLAPSE_PREVIEW_CHARS = 800
+
+# Number of helper models queried at the same time. Set to 1 on hosts where
+# Ollama can only keep a single model in memory.
+HELPER_CONCURRENCY = 2
+
+# Ask the helpers in the background as soon as the main answer is shown, so a "no" does not
+# have to wait for them. Their answers are reused unless the feedback description adds at
+# least SPECULATION_MATERIAL_WORDS words beyond a generic complaint.
+SPECULATIVE_HELPERS = False
+SPECULATION_MATERIAL_WORDS = 3
+GENERIC_FEEDBACK_WORDS = {
+    "a", "an", "the", "it", "its", "this", "that", "is", "was", "are", "be", "not", "no", "dont",
+    "doesnt", "didnt", "isnt", "wasnt", "does", "did", "do", "work", "works", "working", "worked",
+    "wrong", "bad", "incorrect", "broken", "fails", "failed", "error", "errors", "helpful", "useful",
+    "answer", "response", "solution", "code", "right", "correct", "still", "try", "again", "please",
+    "you", "your", "i", "me", "my", "just", "at", "all", "very", "really", "quite", "good", "enough",
+}
+
+# Model requests allowed in flight at once across all open conversations. Match it to
+# OLLAMA_NUM_PARALLEL (and the number of models the server can keep loaded).
+MAX_CONCURRENT_REQUESTS = 4
+
+# Longest time in seconds each role may take for one answer before the call is aborted
+# (None for no limit).
+ROLE_DEADLINES = {"Main Developer": 300, "Helper 1": 180, "Helper 2": 180, "Summary": 120}
+# Once one helper has answered, the other gets at most this many more seconds. The improved
+# answer then goes ahead with whichever helpers made it.
+HELPER_HEDGE_SECONDS = 60
+# How often a waiting call checks for cancellation, and how long the Ollama client waits for
+# the next bytes before giving up on a connection that has stalled completely. Connecting
+# gives up much sooner, so a server that is down is skipped while the call still has time.
+CANCEL_POLL_INTERVAL = 0.1
+OLLAMA_READ_TIMEOUT = 300
+OLLAMA_CONNECT_TIMEOUT = 5
+
+# Rough BPE behaviour: short words are one token and long identifiers split every ~8 chars,
+# digits, symbols and CJK characters are usually a token each, and other scripts average
+# about two characters per token. Code and non-English text come out far above len // 4.
+TOKEN_PATTERN = re.compile(
+    r"(?P<word>[A-Za-z]+)|(?P<cjk>[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af])|"
+    r"(?P<other>[^\W\d_A-Za-z\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]+)|(?P<newline>\n)|"
+    r"(?P<indent> {2,}|\t+)|(?P<symbol>[^\w\s]|\d|_)"
+)
 
 def estimate_tokens(text):
-    return len(text) // 4
+    tokens = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        kind = match.lastgroup
+        if kind == "word":
+            tokens += 1 + len(match.group()) // 8
+        elif kind == "other":
+            tokens += (len(match.group()) + 1) // 2
+        else:
+            tokens += 1
+    return tokens
+
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+
+def load_tokenizer(model):
+    with _tokenizers_lock:
+        if model not in _tokenizers:
+            tokenizer = None
+            if model in MODEL_TOKENIZERS:
+                try:
+                    from transformers import AutoTokenizer
+                    tokenizer = AutoTokenizer.from_pretrained(MODEL_TOKENIZERS[model])
+                except Exception as e:
+                    print(f"Tokenizer for {model} unavailable, estimating token counts: {e}")
+            _tokenizers[model] = tokenizer
+        return _tokenizers[model]
+
+# Other counters can be plugged in per model with TOKEN_COUNTERS[model] = (name, function).
+TOKEN_COUNTERS = {}
+
+def get_token_counter(model=None):
+    if model in TOKEN_COUNTERS:
+        return TOKEN_COUNTERS[model]
+    tokenizer = load_tokenizer(model) if model else None
+    if tokenizer is not None:
+        return MODEL_TOKENIZERS[model], lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+    return "heuristic", estimate_tokens
+
+def count_tokens(text, model=None):
+    return get_token_counter(model)[1](text)
+
+_token_counts = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+# Counts are cached by counter name and message text rather than stored on the entry, so they
+# never end up in saved conversations or exports.
+def entry_tokens(entry, model=None):
+    name, counter = get_token_counter(model)
+    key = (name, entry["role"], str(entry["content"]))
+    with _token_counts_lock:
+        count = _token_counts.get(key)
+        if count is not None:
+            _token_counts.move_to_end(key)
+            return count
+    count = counter(f"{entry['role']}: {entry['content']}")
+    with _token_counts_lock:
+        _token_counts[key] = count
+        while len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    return count
+
+def history_tokens(chat_history, model=None):
+    return sum(entry_tokens(entry, model) + 1 for entry in chat_history)
+
+def context_window(model):
+    if model in MODEL_CONTEXT_WINDOWS:
+        return MODEL_CONTEXT_WINDOWS[model]
+    return model_catalog.context_window(model) or DEFAULT_CONTEXT_WINDOW
+
+# Remembers the num_ctx each model was last run with, so requests only change it in coarse steps.
+class ContextSizer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sizes = {}
+
+    def current(self, model):
+        with self.lock:
+            return self.sizes.get(model, min(NUM_CTX_INITIAL, context_window(model)))
+
+    def size_for(self, model, needed):
+        window = context_window(model)
+        step = min(next((step for step in NUM_CTX_STEPS if step >= needed), NUM_CTX_STEPS[-1]), window)
+        with self.lock:
+            current = self.sizes.get(model, min(NUM_CTX_INITIAL, window))
+            if step > current or step * NUM_CTX_SHRINK_FACTOR <= current:
+                current = step
+            self.sizes[model] = current
+            return current
+
+context_sizer = ContextSizer()
+
+def generation_options(model, role, prompt_tokens):
+    options = {}
+    for key in ("*", role, model, (model, role)):
+        options.update(GENERATION_PROFILES.get(key, {}))
+    if not options.get("num_ctx"):
+        output_budget = options.get("num_predict") or 0
+        if output_budget < 0:
+            output_budget = NUM_CTX_STEPS[0]
+        options["num_ctx"] = context_sizer.size_for(model, int(prompt_tokens * NUM_CTX_PROMPT_MARGIN) + output_budget)
+    return {name: value for name, value in options.items() if value is not None}
+
+# Timing and size of one model call. Passed in the "callbacks" of a call's config to catch the
+# first token and Ollama's final statistics (load_duration, eval_count, ...).
+class CallMetrics:
+    def __init__(self, model, role, prompt):
+        self.model = model
+        self.role = role
+        self.prompt_chars = len(prompt)
+        self.prompt_tokens = count_tokens(prompt, model)
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.first_token = None
+        self.generation_info = {}
+        self.cached = False
+        self.error = None
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.mark_token()
+
+    def on_llm_end(self, response, **kwargs):
+        try:
+            self.generation_info = response.generations[0][0].generation_info or {}
+        except (IndexError, AttributeError):
+            pass
+
+    def mark_token(self):
+        if self.first_token is None:
+            self.first_token = time.monotonic()
+
+    def finish(self, text):
+        duration = time.monotonic() - self.started
+        ttft = self.first_token - self.started if self.first_token is not None else None
+        info = self.generation_info
+        seconds = lambda key: info[key] / 1e9 if info.get(key) is not None else None
+        eval_count = info.get("eval_count")
+        output_tokens = eval_count if eval_count is not None else count_tokens(text, self.model)
+        if eval_count and info.get("eval_duration"):
+            tokens_per_second = eval_count / seconds("eval_duration")
+        else:
+            generation_time = duration - (ttft or 0.0)
+            tokens_per_second = output_tokens / generation_time if generation_time > 0 else None
+        return {
+            "model": self.model,
+            "role": self.role,
+            "started_at": round(self.started_at, 3),
+            "prompt_chars": self.prompt_chars,
+            "prompt_tokens": self.prompt_tokens,
+            "output_chars": len(text),
+            "output_tokens": output_tokens,
+            "ttft": round(ttft, 3) if ttft is not None else None,
+            "duration": round(duration, 3),
+            "tokens_per_second": round(tokens_per_second, 1) if tokens_per_second else None,
+            "load_duration": seconds("load_duration"),
+            "prompt_eval_count": info.get("prompt_eval_count"),
+            "prompt_eval_duration": seconds("prompt_eval_duration"),
+            "eval_count": eval_count,
+            "eval_duration": seconds("eval_duration"),
+            "cached": self.cached,
+            "error": self.error,
+        }
+
+class MetricsLog:
+    def __init__(self, size=METRICS_LOG_SIZE):
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=size)
+        self.totals = {}
+
+    def add(self, metrics):
+        with self.lock:
+            self.recent.append(metrics)
+            totals = self.totals.setdefault((metrics["model"], metrics["role"]), {
+                "requests": 0, "errors": 0, "cached": 0, "prompt_tokens": 0, "output_tokens": 0,
+                "duration": 0.0, "ttft": 0.0, "ttft_count": 0, "load_duration": 0.0,
+            })
+            totals["requests"] += 1
+            totals["errors"] += 1 if metrics["error"] else 0
+            totals["cached"] += 1 if metrics["cached"] else 0
+            totals["prompt_tokens"] += metrics["prompt_tokens"]
+            totals["output_tokens"] += metrics["output_tokens"]
+            totals["duration"] += metrics["duration"]
+            totals["load_duration"] += metrics["load_duration"] or 0.0
+            if metrics["ttft"] is not None:
+                totals["ttft"] += metrics["ttft"]
+                totals["ttft_count"] += 1
+
+    def to_json(self):
+        with self.lock:
+            return json.dumps({
+                "calls": list(self.recent),
+                "totals": [{"model": model, "role": role, **totals} for (model, role), totals in self.totals.items()],
+                "cache": llm_cache.stats(),
+            }, indent=2)
+
+    def to_prometheus(self):
+        metrics = [
+            ("llm_requests_total", "counter", "Model calls made.", "requests"),
+            ("llm_errors_total", "counter", "Model calls that failed.", "errors"),
+            ("llm_cached_total", "counter", "Model calls answered from the response cache.", "cached"),
+            ("llm_prompt_tokens_total", "counter", "Prompt tokens sent.", "prompt_tokens"),
+            ("llm_output_tokens_total", "counter", "Tokens generated.", "output_tokens"),
+            ("llm_duration_seconds_total", "counter", "Wall time spent in model calls.", "duration"),
+            ("llm_ttft_seconds_total", "counter", "Summed time to first token.", "ttft"),
+            ("llm_ttft_observations_total", "counter", "Calls with a measured time to first token.", "ttft_count"),
+            ("llm_load_seconds_total", "counter", "Time Ollama spent loading models.", "load_duration"),
+        ]
+        escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        lines = []
+        with self.lock:
+            for name, kind, help_text, key in metrics:
+                lines.append(f"# HELP codecollab_{name} {help_text}")
+                lines.append(f"# TYPE codecollab_{name} {kind}")
+                for (model, role), totals in sorted(self.totals.items()):
+                    lines.append(f'codecollab_{name}{{model="{escape(model)}",role="{escape(role)}"}} {totals[key]}')
+        for key, value in llm_cache.stats().items():
+            lines.append(f"# TYPE codecollab_llm_cache_{key} gauge")
+            lines.append(f"codecollab_llm_cache_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics_log = MetricsLog()
+
+# One-line summary of a call for the status bar, e.g. "Main Developer · codellama · 812 tok · TTFT 0.41s · 23.5 tok/s · 6.2s".
+def format_metrics(metrics):
+    parts = [metrics["role"], metrics["model"], f"{metrics['prompt_tokens']} tok"]
+    if metrics["cached"]:
+        parts.append("cached")
+    if metrics["ttft"] is not None:
+        parts.append(f"TTFT {metrics['ttft']:.2f}s")
+    if metrics["tokens_per_second"]:
+        parts.append(f"{metrics['tokens_per_second']:.1f} tok/s")
+    if metrics["load_duration"]:
+        parts.append(f"load {metrics['load_duration']:.1f}s")
+    parts.append(f"{metrics['duration']:.1f}s")
+    if metrics["error"]:
+        parts.append("failed")
+    return " · ".join(parts)
+
+class GenerationCancelled(Exception):
+    pass
+
+class GenerationTimeout(GenerationCancelled):
+    pass
+
+class CancelToken:
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+# A low_priority flag that can be cleared while its calls are still waiting for a slot, e.g.
+# once the programmer asks for answers that were being fetched in the background.
+class Priority:
+    def __init__(self, low=True):
+        self.low = low
+
+    def __bool__(self):
+        return self.low
+
+# Lets another thread drop the connection of an Ollama request, e.g. one still waiting for its
+# first token while the server processes the prompt. Closing a socket does not wake a thread
+# blocked reading it, so the connection is shut down instead.
+class RequestAbort:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sockets = []
+        self.aborted = False
+
+    # httpcore "trace" callback: remembers the socket of every connection the request opens.
+    def trace(self, event, info):
+        if event != "connection.connect_tcp.complete":
+            return
+        sock = info["return_value"].get_extra_info("socket")
+        with self.lock:
+            if not self.aborted:
+                self.sockets.append(sock)
+                return
+        self.shutdown(sock)
+
+    def abort(self):
+        with self.lock:
+            self.aborted = True
+            sockets, self.sockets = self.sockets, []
+        for sock in sockets:
+            self.shutdown(sock)
+
+    @staticmethod
+    def shutdown(sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+_current_abort = threading.local()
+
+# httpx request hook of the Ollama clients: traces the request with the RequestAbort of the
+# call running on this thread, if any.
+def attach_request_abort(request):
+    abort = getattr(_current_abort, "abort", None)
+    if abort is not None:
+        request.extensions["trace"] = abort.trace
+
+# Reads `chunks` on a daemon thread so a stalled call can be abandoned. The returned iterator
+# raises when `token` is cancelled or the time.monotonic() value returned by `deadline()`
+# (None for no limit) passes; `abort` then drops the HTTP connection, so Ollama stops working
+# on the request even before its first token. `finished` is set once the reading thread has
+# really ended.
+def iterate_until(chunks, token, deadline, role, abort=None, finished=None):
+    items = queue.Queue()
+    stop = threading.Event()
+
+    def pump():
+        try:
+            for chunk in chunks:
+                if stop.is_set():
+                    break
+                items.put(("chunk", chunk))
+            items.put(("done", None))
+        except Exception as e:
+            items.put(("error", e))
+        finally:
+            chunks.close()
+            if finished is not None:
+                finished.set()
+
+    started = time.monotonic()
+    reader = threading.Thread(target=pump, daemon=True)
+    reader.start()
+    return read_until(items, stop, reader, token, deadline, role, abort, started)
+
+def read_until(items, stop, reader, token, deadline, role, abort, started):
+    try:
+        while True:
+            if token.cancelled:
+                raise GenerationCancelled("Generation cancelled.")
+            limit = deadline()
+            timeout = CANCEL_POLL_INTERVAL
+            if limit is not None:
+                timeout = min(timeout, limit - time.monotonic())
+                if timeout <= 0:
+                    raise GenerationTimeout(f"{role} timed out after {time.monotonic() - started:.0f}s.")
+            try:
+                kind, value = items.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if kind == "error":
+                raise value
+            if kind == "done":
+                return
+            yield value
+    finally:
+        stop.set()
+        if abort is not None and reader.is_alive():
+            abort.abort()
+
+# Writes `data` as JSON to a temporary file next to `path`, syncs it and renames it into place,
+# so a crash never leaves a half-written file behind. Each write gets its own temporary name,
+# so concurrent writers of the same file cannot clobber each other's data.
+def atomic_write_json(path, data):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class CacheMissError(Exception):
+    pass
+
+class LLMResponseCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index = None
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Files are kept in least-recently-used order by mtime, which hits refresh.
+    def _load_index(self):
+        if self.index is not None:
+            return
+        self.index = OrderedDict()
+        if os.path.isdir(self.directory):
+            files = []
+            for filename in os.listdir(self.directory):
+                if filename.endswith(".json"):
+                    stat = os.stat(os.path.join(self.directory, filename))
+                    files.append((stat.st_mtime, filename[:-5], stat.st_size))
+            for _, key, size in sorted(files):
+                self.index[key] = size
+                self.total_bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        with self.lock:
+            self._load_index()
+            if key not in self.index:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    text = json.load(f)["text"]
+                os.utime(self._path(key))
+            except Exception as e:
+                print(f"Error reading cached response {key}: {e}")
+                self.total_bytes -= self.index.pop(key)
+                self.misses += 1
+                return None
+            self.index.move_to_end(key)
+            self.hits += 1
+            return text
+
+    def put(self, key, model, text):
+        with self.lock:
+            self._load_index()
+            try:
+                atomic_write_json(self._path(key), {"model": model, "text": text})
+                size = os.path.getsize(self._path(key))
+            except Exception as e:
+                print(f"Error caching response {key}: {e}")
+                return
+            self.total_bytes += size - self.index.pop(key, 0)
+            self.index[key] = size
+            while self.total_bytes > self.max_bytes and len(self.index) > 1:
+                old_key, old_size = self.index.popitem(last=False)
+                self.total_bytes -= old_size
+                self.evictions += 1
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.index or {}),
+                "bytes": self.total_bytes,
+            }
+
+llm_cache = LLMResponseCache(LLM_CACHE_DIR, LLM_CACHE_MAX_BYTES)
+
+# Wraps an OllamaLLM so identical requests are answered from llm_cache. Attributes that are
+# not overridden here are read from the wrapped model.
+class CachedLLM:
+    def __init__(self, llm, cache=llm_cache, mode=None):
+        self.llm = llm
+        self.cache = cache
+        self.mode = mode or LLM_CACHE_MODE
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def cache_key(self, prompt, overrides=None):
+        options = {name: getattr(self.llm, name, None) for name in LLM_CACHE_OPTIONS}
+        options.update({name: value for name, value in (overrides or {}).items() if name in LLM_CACHE_OPTIONS})
+        payload = json.dumps({"model": self.llm.model, "options": options, "prompt": prompt},
+                             sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt, options=None):
+        if self.mode == "off":
+            return None, None
+        key = self.cache_key(prompt, options)
+        text = self.cache.get(key)
+        if text is None and self.mode == "replay":
+            raise CacheMissError(f"No cached response from {self.llm.model} for this prompt (replay mode)")
+        return key, text
+
+    @staticmethod
+    def mark_cached(config):
+        for handler in (config or {}).get("callbacks") or []:
+            if isinstance(handler, CallMetrics):
+                handler.cached = True
+
+    def invoke(self, prompt, config=None, options=None):
+        key, text = self.lookup(prompt, options)
+        if text is not None:
+            self.mark_cached(config)
+            return text
+        text = self.llm.invoke(prompt, config=config, options=options)
+        if key is not None:
+            self.cache.put(key, self.llm.model, text)
+        return text
+
+    def stream(self, prompt, config=None, options=None):
+        key, text = self.lookup(prompt, options)
+        if text is not None:
+            self.mark_cached(config)
+            yield text
+            return
+        chunks = []
+        for chunk in self.llm.stream(prompt, config=config, options=options):
+            chunks.append(chunk)
+            yield chunk
+        if key is not None:
+            self.cache.put(key, self.llm.model, "".join(chunks))
+
+def ollama_request(path, payload=None, base_url=OLLAMA_BASE_URL, timeout=10):
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    request = urllib.request.Request(base_url.rstrip("/") + path, data=data,
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read().decode("utf-8") or "{}")
+
+class OllamaEndpoint:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.healthy = True
+        self.models = None
+        self.loaded = set()
+        self.in_flight = 0
+        self.latency = None
+        self.last_error = None
+
+    # Reads the installed and loaded models. Until the first probe the endpoint is assumed to
+    # be healthy and to have every model.
+    def probe(self):
+        try:
+            models = ollama_request("/api/tags", base_url=self.base_url, timeout=3)["models"]
+            loaded = ollama_request("/api/ps", base_url=self.base_url, timeout=3)["models"]
+        except Exception as e:
+            self.healthy = False
+            self.last_error = str(e)
+            return False
+        names = set()
+        for model in models:
+            names.add(model["name"])
+            if model["name"].endswith(":latest"):
+                names.add(model["name"][:-len(":latest")])
+        self.models = names
+        self.loaded = {model["name"] for model in loaded}
+        self.healthy = True
+        self.last_error = None
+        return True
+
+    def has_model(self, model):
+        return self.models is None or model in self.models or f"{model}:latest" in self.models
+
+    def expected_wait(self, model):
+        wait = (self.in_flight + 1) * (self.latency or ENDPOINT_DEFAULT_LATENCY)
+        if model not in self.loaded and f"{model}:latest" not in self.loaded:
+            wait += MODEL_LOAD_SECONDS * (len(self.loaded) + 1)
+        return wait
+
+# Routes requests over several Ollama servers and checks their health and model inventory in
+# the background. With a single server there is nothing to choose, so no checks run.
+class EndpointPool:
+    def __init__(self, urls=None, check_interval=ENDPOINT_CHECK_INTERVAL):
+        self.endpoints = [OllamaEndpoint(url) for url in dict.fromkeys(urls or OLLAMA_ENDPOINTS)]
+        self.lock = threading.Lock()
+        self.check_interval = check_interval
+        if len(self.endpoints) > 1:
+            threading.Thread(target=self._check_worker, daemon=True).start()
+
+    def _check_worker(self):
+        while True:
+            self.probe_all()
+            time.sleep(self.check_interval)
+
+    def probe_all(self):
+        with ThreadPoolExecutor(max_workers=len(self.endpoints)) as executor:
+            list(executor.map(lambda endpoint: endpoint.probe(), self.endpoints))
+
+    # Picks the endpoint for the next request of `model`, skipping `exclude`, and counts the
+    # request as in flight until release().
+    def acquire(self, model, exclude=()):
+        with self.lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+            if not candidates:
+                return None
+            healthy = [endpoint for endpoint in candidates if endpoint.healthy] or candidates
+            with_model = [endpoint for endpoint in healthy if endpoint.has_model(model)] or healthy
+            endpoint = min(with_model, key=lambda endpoint: endpoint.expected_wait(model))
+            endpoint.in_flight += 1
+            endpoint.loaded.add(model)
+            return endpoint
+
+    def release(self, endpoint, latency=None, error=None):
+        with self.lock:
+            endpoint.in_flight -= 1
+            if latency is not None:
+                if endpoint.latency is None:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency += ENDPOINT_LATENCY_SMOOTHING * (latency - endpoint.latency)
+            if error is not None:
+                # Leave the endpoint out until the next health check finds it up again.
+                endpoint.healthy = False
+                endpoint.last_error = error
+
+    def status(self):
+        with self.lock:
+            return [{"url": endpoint.base_url, "healthy": endpoint.healthy, "in_flight": endpoint.in_flight,
+                     "latency": round(endpoint.latency, 3) if endpoint.latency is not None else None,
+                     "models": sorted(endpoint.models) if endpoint.models is not None else None,
+                     "loaded": sorted(endpoint.loaded), "error": endpoint.last_error}
+                    for endpoint in self.endpoints]
+
+OLLAMA_OPTIONS = ("mirostat", "mirostat_eta", "mirostat_tau", "num_ctx", "num_gpu", "num_thread", "num_predict",
+                  "repeat_last_n", "repeat_penalty", "temperature", "seed", "stop", "tfs_z", "top_k", "top_p")
+
+_metrics_handler_class = None
+
+# Replaces the CallMetrics in a config's callbacks with LangChain handlers forwarding to them
+# and drops the RequestAbort under "abort", which RoutedLLM uses itself.
+# The handler class is defined on first use so LangChain is not imported at startup.
+def langchain_config(config):
+    global _metrics_handler_class
+    config = {name: value for name, value in (config or {}).items() if name != "abort"}
+    callbacks = config.get("callbacks")
+    if not callbacks:
+        return config
+    if _metrics_handler_class is None:
+        from langchain_core.callbacks import BaseCallbackHandler
+
+        class MetricsHandler(BaseCallbackHandler):
+            def __init__(self, metrics):
+                self.metrics = metrics
+
+            def on_llm_new_token(self, token, **kwargs):
+                self.metrics.on_llm_new_token(token, **kwargs)
+
+            def on_llm_end(self, response, **kwargs):
+                self.metrics.on_llm_end(response, **kwargs)
+
+        _metrics_handler_class = MetricsHandler
+    handlers = [_metrics_handler_class(handler) if isinstance(handler, CallMetrics) else handler
+                for handler in callbacks]
+    return {**config, "callbacks": handlers}
+
+# One model spread over the endpoints of an EndpointPool. Each request is sent to the endpoint
+# the pool picks; if that server cannot be reached before any output arrives, the request
+# moves on to the next one.
+class RoutedLLM:
+    def __init__(self, model, endpoints, keep_alive=MODEL_KEEP_ALIVE):
+        self.model = model
+        self.endpoints = endpoints
+        self.keep_alive = keep_alive
+        self.lock = threading.Lock()
+        self.llms = {}
+        self.default = self.client(endpoints.endpoints[0])
+
+    def __getattr__(self, name):
+        return getattr(self.default, name)
+
+    # Connections are not kept alive, so every request opens its own and a RequestAbort can
+    # shut it down without touching other calls.
+    def client(self, endpoint):
+        import httpx
+        from langchain_ollama import OllamaLLM
+        with self.lock:
+            if endpoint.base_url not in self.llms:
+                self.llms[endpoint.base_url] = OllamaLLM(
+                    model=self.model, base_url=endpoint.base_url, keep_alive=self.keep_alive,
+                    client_kwargs={"timeout": httpx.Timeout(OLLAMA_READ_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT),
+                                   "limits": httpx.Limits(max_keepalive_connections=0),
+                                   "event_hooks": {"request": [attach_request_abort]}})
+            return self.llms[endpoint.base_url]
+
+    # Ollama takes the options of a request as one dict, so per-call overrides are merged
+    # with the client's own settings.
+    @staticmethod
+    def request_options(llm, overrides):
+        options = {name: getattr(llm, name) for name in OLLAMA_OPTIONS}
+        options.update(overrides)
+        return options
+
+    def invoke(self, prompt, config=None, options=None):
+        return "".join(self.stream(prompt, config=config, options=options))
+
+    def stream(self, prompt, config=None, options=None):
+        import httpx
+        abort = (config or {}).get("abort")
+        config = langchain_config(config)
+        tried = []
+        while True:
+            endpoint = self.endpoints.acquire(self.model, exclude=tried)
+            if endpoint is None:
+                raise ConnectionError(f"No Ollama server could be reached for {self.model}")
+            tried.append(endpoint)
+            started = time.monotonic()
+            latency = None
+            try:
+                llm = self.client(endpoint)
+                kwargs = {"options": self.request_options(llm, options)} if options else {}
+                _current_abort.abort = abort
+                for chunk in llm.stream(prompt, config=config, **kwargs):
+                    if latency is None:
+                        latency = time.monotonic() - started
+                    yield chunk
+            except (ConnectionError, httpx.TransportError) as e:
+                if abort is not None and abort.aborted:
+                    self.endpoints.release(endpoint, latency)
+                    raise
+                self.endpoints.release(endpoint, error=str(e))
+                if latency is not None:
+                    raise
+                print(f"Error reaching {endpoint.base_url} for {self.model}: {e}")
+                continue
+            except BaseException:
+                self.endpoints.release(endpoint, latency)
+                raise
+            self.endpoints.release(endpoint, latency)
+            return
+
+# Hands out one client per model and preloads models on the Ollama servers so the first
+# request does not pay for loading them. Warm-ups run one at a time, so a host that cannot
+# hold every model does not thrash between them.
+class ModelPool:
+    def __init__(self, base_url=None, keep_alive=MODEL_KEEP_ALIVE, endpoints=None):
+        self.endpoints = EndpointPool(endpoints or ([base_url] if base_url else None))
+        self.keep_alive = keep_alive
+        self.lock = threading.Lock()
+        self.llms = {}
+        self.warming = set()
+        self.warm_queue = queue.Queue()
+        threading.Thread(target=self._warm_worker, daemon=True).start()
+
+    def get(self, model):
+        with self.lock:
+            if model not in self.llms:
+                self.llms[model] = CachedLLM(RoutedLLM(model, self.endpoints, self.keep_alive))
+            return self.llms[model]
+
+    def warm(self, models, on_done=None):
+        for model in dict.fromkeys(models):
+            with self.lock:
+                if model in self.warming:
+                    continue
+                self.warming.add(model)
+            self.warm_queue.put((model, on_done))
+
+    def _warm_worker(self):
+        while True:
+            model, on_done = self.warm_queue.get()
+            self._warm(model, on_done)
+
+    def _warm(self, model, on_done):
+        endpoint = self.endpoints.acquire(model)
+        error = None
+        try:
+            # A generate request without a prompt only loads the model.
+            # Load it with the num_ctx the next request will most likely use, or it is reloaded.
+            ollama_request("/api/generate", {"model": model, "keep_alive": self.keep_alive,
+                                             "options": {"num_ctx": context_sizer.current(model)}},
+                           endpoint.base_url, timeout=300)
+        except Exception as e:
+            # Only a server that cannot be reached is left out; an HTTP error such as a 404
+            # for a model it does not have says nothing about its other models.
+            if isinstance(e, OSError) and not isinstance(e, urllib.error.HTTPError):
+                error = str(e)
+            print(f"Error warming model {model}: {e}")
+        finally:
+            self.endpoints.release(endpoint, error=error)
+            with self.lock:
+                self.warming.discard(model)
+        if on_done:
+            on_done()
+
+    def loaded_models(self):
+        endpoints = self.endpoints.endpoints
+        loaded = []
+        for endpoint in endpoints:
+            try:
+                models = ollama_request("/api/ps", base_url=endpoint.base_url)["models"]
+            except Exception as e:
+                print(f"Error listing loaded models on {endpoint.base_url}: {e}")
+                continue
+            host = urllib.parse.urlsplit(endpoint.base_url).netloc
+            loaded.extend(model["name"] if len(endpoints) == 1 else f"{model['name']} @ {host}" for model in models)
+        return loaded
+
+# Runs (key, callable) pairs in parallel and yields (key, result) as each one finishes.
+def run_concurrently(tasks, max_workers=HELPER_CONCURRENCY):
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(func): key for key, func in tasks}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+# Caps the number of model requests in flight across all conversations, so several chats can
+# run at once without queueing more work on the Ollama server than it can serve in parallel.
+# Low priority requests (speculative helpers) only take a free slot while no normal request
+# is waiting for one.
+class RequestScheduler:
+    def __init__(self, limit=MAX_CONCURRENT_REQUESTS):
+        self.limit = max(1, limit)
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+
+    # `low_priority` is checked on every pass, so a Priority raised while waiting stops yielding.
+    def acquire(self, token, low_priority=False):
+        with self.condition:
+            counted = not low_priority
+            if counted:
+                self.waiting += 1
+            try:
+                while self.active >= self.limit or (low_priority and self.waiting):
+                    if token.cancelled:
+                        raise GenerationCancelled("Generation cancelled.")
+                    self.condition.wait(CANCEL_POLL_INTERVAL)
+                self.active += 1
+            finally:
+                if counted:
+                    self.waiting -= 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    # Gives the slot back once `event` is set, so a call abandoned by its round keeps counting
+    # until its request to Ollama has really ended.
+    def release_when(self, event):
+        if event.is_set():
+            self.release()
+            return
 
+        def wait():
+            event.wait()
+            self.release()
+        threading.Thread(target=wait, daemon=True).start()
+
+request_scheduler = RequestScheduler()
+
+class ModelCatalog:
+    def __init__(self, path=MODEL_CATALOG_PATH, ttl=MODEL_CATALOG_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.fetched_at = 0
+        self.model_names = []
+        self.context_windows = {}
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.fetched_at = data["fetched_at"]
+            self.model_names = data["models"]
+            self.context_windows = data["context_windows"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Error loading model list {self.path}: {e}")
+
+    def models(self):
+        with self.lock:
+            return list(self.model_names) or list(FALLBACK_MODELS)
+
+    def context_window(self, model):
+        with self.lock:
+            return self.context_windows.get(model)
+
+    def stale(self):
+        return time.time() - self.fetched_at > self.ttl
+
+    # Reads the models installed on every server. /api/show is only asked about models whose
+    # context window is not known yet. Returns False when no server could be reached, leaving
+    # the cached list in place.
+    def refresh(self, urls=None):
+        names = []
+        reached = False
+        for url in dict.fromkeys(urls or OLLAMA_ENDPOINTS):
+            try:
+                tags = ollama_request("/api/tags", base_url=url, timeout=5)
+            except Exception as e:
+                print(f"Error listing models on {url}: {e}")
+                continue
+            reached = True
+            names.extend(model["name"] for model in tags.get("models", []))
+            for name in tags.get("models", []):
+                name = name["name"]
+                if self.context_window(name) is None:
+                    window = self.fetch_context_window(url, name)
+                    if window:
+                        with self.lock:
+                            self.context_windows[name] = window
+        if not reached:
+            return False
+        with self.lock:
+            self.model_names = sorted(dict.fromkeys(names))
+            self.fetched_at = time.time()
+            data = {"fetched_at": self.fetched_at, "models": self.model_names,
+                    "context_windows": self.context_windows}
+        try:
+            atomic_write_json(self.path, data)
+        except Exception as e:
+            print(f"Error saving model list {self.path}: {e}")
+        return True
+
+    @staticmethod
+    def fetch_context_window(url, model):
+        try:
+            info = ollama_request("/api/show", {"model": model}, base_url=url, timeout=10).get("model_info", {})
+        except Exception as e:
+            print(f"Error reading details of {model}: {e}")
+            return None
+        for key, value in info.items():
+            if key.endswith(".context_length"):
+                return int(value)
+        return None
+
+    # Refreshes on a daemon thread when the list is stale (or always with force) and calls
+    # on_done(models) afterwards.
+    def refresh_async(self, on_done=None, force=False):
+        with self.lock:
+            if self.refreshing or not (force or self.stale()):
+                return False
+            self.refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                with self.lock:
+                    self.refreshing = False
+            if on_done:
+                on_done(self.models())
+
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+model_catalog = ModelCatalog()
+
+# Never waits for the network: returns the cached model list, or FALLBACK_MODELS before the
+# first successful refresh.
 def get_available_models():
-    return ["qwen2.5-coder:latest", "qwen3:4b", "gemma3:4b"]
+    return model_catalog.models()
+
+class ConversationJournal:
+    def __init__(self, filename):
+        self.path = os.path.join(CONVERSATION_DIR, filename)
+        self.journal_path = os.path.splitext(self.path)[0] + ".jsonl"
+        # Reentrant because compacting a HistoryWindow reads its older messages back from here.
+        self.lock = threading.RLock()
+        self.handle = None
+        self.persisted = None
+        self.journal_entries = 0
+        self.last_fsync = 0.0
+        self.unsynced = False
+        self.flush_timer = None
+
+    def load(self):
+        with self.lock:
+            entries, journal_entries, torn = self._read()
+            self.persisted = len(entries)
+            self.journal_entries = journal_entries
+            if torn:
+                self._compact(entries)
+            return entries
+
+    def read(self, start, stop):
+        with self.lock:
+            return self._read()[0][start:stop]
+
+    def _read(self):
+        entries = []
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        journal_entries = 0
+        torn = False
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        torn = True
+                        break
+                    # Records already folded into the snapshot are left over from an
+                    # interrupted compaction; a gap means the journal is unusable past it.
+                    if record["index"] < len(entries):
+                        continue
+                    if record["index"] > len(entries):
+                        torn = True
+                        break
+                    entries.append(record["entry"])
+                    journal_entries += 1
+        return entries, journal_entries, torn
+
+    def save(self, chat_history):
+        with self.lock:
+            if self.persisted is None or len(chat_history) < self.persisted:
+                self._compact(chat_history)
+                return
+            new_entries = chat_history[self.persisted:]
+            if not new_entries:
+                return
+            if self.journal_entries + len(new_entries) > JOURNAL_COMPACT_ENTRIES:
+                self._compact(chat_history)
+                return
+            if self.handle is None:
+                self.handle = open(self.journal_path, "a")
+            for index, entry in enumerate(new_entries, self.persisted):
+                self.handle.write(json.dumps({"index": index, "entry": entry}) + "\n")
+            self.handle.flush()
+            self.persisted = len(chat_history)
+            self.journal_entries += len(new_entries)
+            self.unsynced = True
+            if time.monotonic() - self.last_fsync >= JOURNAL_FSYNC_INTERVAL:
+                self._fsync()
+            elif self.flush_timer is None:
+                # The last write of a burst is synced at most JOURNAL_FSYNC_INTERVAL later.
+                self.flush_timer = threading.Timer(JOURNAL_FSYNC_INTERVAL, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def compact(self, chat_history):
+        with self.lock:
+            self._compact(chat_history)
+
+    def flush(self):
+        with self.lock:
+            self.flush_timer = None
+            if self.unsynced and self.handle is not None:
+                self._fsync()
+
+    def close(self):
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if self.handle is not None:
+                if self.unsynced:
+                    self._fsync()
+                self.handle.close()
+                self.handle = None
+
+    def delete(self):
+        self.close()
+        with self.lock:
+            for path in (self.path, self.journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.persisted = None
+            self.journal_entries = 0
+
+    def _fsync(self):
+        os.fsync(self.handle.fileno())
+        self.last_fsync = time.monotonic()
+        self.unsynced = False
+
+    def _compact(self, chat_history):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(list(chat_history), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.persisted = len(chat_history)
+        self.journal_entries = 0
+        self.unsynced = False
+
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+def get_journal(filename):
+    with _journals_lock:
+        if filename not in _journals:
+            _journals[filename] = ConversationJournal(filename)
+        return _journals[filename]
+
+@atexit.register
+def close_journals():
+    with _journals_lock:
+        journals = list(_journals.values())
+    for journal in journals:
+        journal.close()
+
+class SQLiteConversationStore:
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.persisted = {}
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    name TEXT PRIMARY KEY,
+                    updated REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY,
+                    conversation TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    meta TEXT,
+                    UNIQUE (conversation, position)
+                );
+            """)
+        try:
+            with self.connection:
+                self.connection.executescript("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+                        USING fts5(content, role, content='messages', content_rowid='id');
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                        INSERT INTO messages_fts(rowid, content, role) VALUES (new.id, new.content, new.role);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                        INSERT INTO messages_fts(messages_fts, rowid, content, role)
+                            VALUES ('delete', old.id, old.content, old.role);
+                    END;
+                """)
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            print(f"Full-text search unavailable, falling back to LIKE queries: {e}")
+            self.fts = False
+        if not self.list():
+            self.import_json_conversations()
+
+    def import_json_conversations(self):
+        for filename in os.listdir(CONVERSATION_DIR):
+            if filename.endswith(".json"):
+                try:
+                    self.save(filename, get_journal(filename).load())
+                except Exception as e:
+                    print(f"Error importing conversation {filename}: {e}")
+
+    def load(self, name):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT role, content, meta FROM messages WHERE conversation = ? ORDER BY position",
+                (name,)).fetchall()
+            self.persisted[name] = len(rows)
+        return self._entries(rows)
+
+    # Returns the message count and the last `count` messages.
+    def load_tail(self, name, count):
+        with self.lock:
+            total = self.connection.execute(
+                "SELECT COUNT(*) FROM messages WHERE conversation = ?", (name,)).fetchone()[0]
+            self.persisted[name] = total
+            rows = self.connection.execute(
+                "SELECT role, content, meta FROM messages WHERE conversation = ? AND position >= ? "
+                "ORDER BY position", (name, total - count)).fetchall()
+        return total, self._entries(rows)
+
+    def load_range(self, name, start, stop):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT role, content, meta FROM messages WHERE conversation = ? "
+                "AND position >= ? AND position < ? ORDER BY position", (name, start, stop)).fetchall()
+        return self._entries(rows)
+
+    @staticmethod
+    def _entries(rows):
+        entries = []
+        for role, content, meta in rows:
+            entry = {"role": role, "content": content}
+            if meta:
+                entry.update(json.loads(meta))
+            entries.append(entry)
+        return entries
+
+    def save(self, name, chat_history):
+        with self.lock, self.connection:
+            persisted = self.persisted.get(name)
+            if persisted is None:
+                persisted = self.connection.execute(
+                    "SELECT COUNT(*) FROM messages WHERE conversation = ?", (name,)).fetchone()[0]
+            if len(chat_history) < persisted:
+                self.connection.execute("DELETE FROM messages WHERE conversation = ?", (name,))
+                persisted = 0
+            rows = []
+            for position, entry in enumerate(chat_history[persisted:], persisted):
+                meta = {key: value for key, value in entry.items() if key not in ("role", "content")}
+                rows.append((name, position, entry["role"], str(entry["content"]),
+                             json.dumps(meta) if meta else None))
+            self.connection.executemany(
+                "INSERT INTO messages (conversation, position, role, content, meta) VALUES (?, ?, ?, ?, ?)",
+                rows)
+            self.connection.execute(
+                "INSERT INTO conversations (name, updated) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET updated = excluded.updated",
+                (name, time.time()))
+            self.persisted[name] = len(chat_history)
+
+    def delete(self, name):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM messages WHERE conversation = ?", (name,))
+            self.connection.execute("DELETE FROM conversations WHERE name = ?", (name,))
+            self.persisted.pop(name, None)
+
+    def list(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT name FROM conversations ORDER BY name").fetchall()
+        return [name for (name,) in rows]
+
+    def search(self, query, limit=SEARCH_RESULT_LIMIT):
+        with self.lock:
+            if self.fts:
+                # Quote every term so user input is never parsed as FTS query syntax, and
+                # prefix-match it so results show up while a word is still being typed.
+                match = " ".join('"' + term.replace('"', '""') + '"*' for term in query.split())
+                rows = self.connection.execute(
+                    "SELECT m.conversation, m.position, m.role, "
+                    "snippet(messages_fts, 0, '', '', '...', 12) "
+                    "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                    "WHERE messages_fts MATCH ? ORDER BY rank LIMIT ?",
+                    (match, limit)).fetchall()
+            else:
+                rows = self.connection.execute(
+                    "SELECT conversation, position, role, substr(content, 1, 80) FROM messages "
+                    "WHERE content LIKE ? OR role LIKE ? LIMIT ?",
+                    (f"%{query}%", f"%{query}%", limit)).fetchall()
+        return rows
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+_sqlite_store = None
+_sqlite_store_lock = threading.Lock()
+
+def get_sqlite_store():
+    global _sqlite_store
+    with _sqlite_store_lock:
+        if _sqlite_store is None:
+            _sqlite_store = SQLiteConversationStore(CONVERSATION_DB)
+        return _sqlite_store
+
+@atexit.register
+def close_sqlite_store():
+    if _sqlite_store is not None:
+        _sqlite_store.close()
+
+class ConversationIndex:
+    def __init__(self, path=CONVERSATION_INDEX_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = None
+        self.dirty = False
+        self.last_flush = 0.0
+
+    def load(self):
+        with self.lock:
+            self._load()
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Error loading conversation index {self.path}: {e}")
+
+    @staticmethod
+    def describe(filename, chat_history, previous=None):
+        # Only the messages added since the last update are measured.
+        if previous and previous["messages"] <= len(chat_history):
+            size = previous["size"] + sum(len(str(entry.get("content", "")))
+                                          for entry in chat_history[previous["messages"]:])
+            preview = previous["preview"]
+        else:
+            size = sum(len(str(entry.get("content", ""))) for entry in chat_history)
+            preview = ""
+        if not preview:
+            first = next((entry for entry in chat_history if entry.get("role") == "Programmer"), None)
+            preview = " ".join(str(first["content"]).split())[:PREVIEW_CHARS] if first else ""
+        return {"name": os.path.splitext(filename)[0], "messages": len(chat_history), "size": size,
+                "modified": time.time(), "preview": preview}
+
+    def update(self, filename, chat_history):
+        with self.lock:
+            self._load()
+            self.entries[filename] = self.describe(filename, chat_history, self.entries.get(filename))
+            self.dirty = True
+            if time.monotonic() - self.last_flush >= CONVERSATION_INDEX_FLUSH_INTERVAL:
+                self._flush()
+
+    def remove(self, filename):
+        with self.lock:
+            self._load()
+            if self.entries.pop(filename, None) is not None:
+                self.dirty = True
+                self._flush()
+
+    # Adds conversations the index has not seen (e.g. written by an older version) and drops
+    # the ones that no longer exist. Opens every unseen conversation, so run it off the UI thread.
+    def sync(self):
+        names = set(list_conversations())
+        with self.lock:
+            self._load()
+            missing = names - set(self.entries)
+            for filename in set(self.entries) - names:
+                del self.entries[filename]
+                self.dirty = True
+        for filename in missing:
+            entry = self.describe(filename, load_conversation(filename))
+            path = os.path.join(CONVERSATION_DIR, filename)
+            if os.path.exists(path):
+                entry["modified"] = os.path.getmtime(path)
+            with self.lock:
+                self.entries.setdefault(filename, entry)
+                self.dirty = True
+        self.flush()
+
+    # Returns one page of conversations, most recently changed first, and the total count.
+    def page(self, offset=0, limit=CONVERSATION_PAGE_SIZE):
+        with self.lock:
+            self._load()
+            entries = sorted(self.entries.items(), key=lambda item: item[1]["modified"], reverse=True)
+        end = None if limit is None else offset + limit
+        return entries[offset:end], len(entries)
+
+    def get(self, filename):
+        with self.lock:
+            self._load()
+            return self.entries.get(filename)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.dirty:
+            return
+        try:
+            atomic_write_json(self.path, self.entries)
+            self.dirty = False
+        except Exception as e:
+            print(f"Error saving conversation index {self.path}: {e}")
+        self.last_flush = time.monotonic()
+
+conversation_index = ConversationIndex()
+atexit.register(conversation_index.flush)
+
+# Most recently opened conversation histories, by filename.
+class HistoryCache:
+    def __init__(self, size=HISTORY_CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.histories = OrderedDict()
+
+    def get(self, filename):
+        with self.lock:
+            history = self.histories.get(filename)
+            if history is not None:
+                self.histories.move_to_end(filename)
+            return history
+
+    def put(self, filename, history):
+        with self.lock:
+            self.histories[filename] = history
+            self.histories.move_to_end(filename)
+            while len(self.histories) > self.size:
+                self.histories.popitem(last=False)
+
+    def discard(self, filename):
+        with self.lock:
+            self.histories.pop(filename, None)
+
+history_cache = HistoryCache()
+
+# The last messages of a saved conversation, used in place of the full list: messages before
+# `offset` stay in storage and are read back only when indexed, sliced or iterated.
+# trim() swaps in a new entries list together with the new offset, so readers on another
+# thread always see a matching pair.
+class HistoryWindow:
+    def __init__(self, filename, entries, offset):
+        self.filename = filename
+        self.entries = entries
+        self.offset = offset
+        self.lock = threading.Lock()
+
+    def _window(self):
+        with self.lock:
+            return self.offset, self.entries
+
+    def __len__(self):
+        offset, entries = self._window()
+        return offset + len(entries)
+
+    def __getitem__(self, index):
+        offset, entries = self._window()
+        length = offset + len(entries)
+        if isinstance(index, slice):
+            start, stop, step = index.indices(length)
+            if step != 1:
+                return list(self)[index]
+            if stop <= start:
+                return []
+            older = load_conversation_range(self.filename, start, min(stop, offset)) if start < offset else []
+            return older + entries[max(start - offset, 0):max(stop - offset, 0)]
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("history index out of range")
+        if index >= offset:
+            return entries[index - offset]
+        return load_conversation_range(self.filename, index, index + 1)[0]
+
+    def __iter__(self):
+        offset, entries = self._window()
+        if offset:
+            yield from load_conversation_range(self.filename, 0, offset)
+        yield from entries
+
+    def append(self, entry):
+        with self.lock:
+            self.entries.append(entry)
+
+    # Drops messages before `limit` from memory, keeping at least the last HISTORY_WINDOW_SIZE.
+    def trim(self, limit):
+        with self.lock:
+            offset = min(limit, self.offset + len(self.entries) - HISTORY_WINDOW_SIZE)
+            if offset > self.offset:
+                self.entries = self.entries[offset - self.offset:]
+                self.offset = offset
+
+def list_conversations():
+    if STORAGE_BACKEND == "sqlite":
+        return get_sqlite_store().list()
+    return [filename for filename in os.listdir(CONVERSATION_DIR) if filename.endswith(".json")]
 
 def load_conversation(filename):
     try:
-        with open(os.path.join(CONVERSATION_DIR, filename), "r") as f:
-            return json.load(f)
+        if STORAGE_BACKEND == "sqlite":
+            return get_sqlite_store().load(filename)
+        return get_journal(filename).load()
+    except Exception as e:
+        print(f"Error loading conversation {filename}: {e}")
+        return []
+
+# Opens a conversation with only its last `count` messages in memory. Up to `count` more from
+# `keep_from` on (the ones its summary does not cover yet) are kept too, so building a prompt
+# does not have to read them back; any older gap is folded into the summary by the first build.
+def load_conversation_tail(filename, count=HISTORY_WINDOW_SIZE, keep_from=None):
+    try:
+        if STORAGE_BACKEND == "sqlite":
+            total, entries = get_sqlite_store().load_tail(filename, count)
+        else:
+            entries = get_journal(filename).load()
+            total = len(entries)
+        start = max(total - count, 0)
+        if keep_from is not None:
+            start = min(start, max(keep_from, total - 2 * count))
+        if STORAGE_BACKEND != "sqlite":
+            entries = entries[start:]
+        elif start < total - len(entries):
+            entries = load_conversation_range(filename, start, total - len(entries)) + entries
+        return HistoryWindow(filename, entries, start)
+    except Exception as e:
+        print(f"Error loading conversation {filename}: {e}")
+        return []
+
+def load_conversation_range(filename, start, stop):
+    try:
+        if STORAGE_BACKEND == "sqlite":
+            return get_sqlite_store().load_range(filename, start, stop)
+        return get_journal(filename).read(start, stop)
     except Exception as e:
         print(f"Error loading conversation {filename}: {e}")
         return []
 
 def save_conversation(filename, chat_history):
     try:
-        with open(os.path.join(CONVERSATION_DIR, filename), "w") as f:
-            json.dump(chat_history, f)
+        if STORAGE_BACKEND == "sqlite":
+            get_sqlite_store().save(filename, chat_history)
+        else:
+            get_journal(filename).save(chat_history)
+        conversation_index.update(filename, chat_history)
     except Exception as e:
         print(f"Error saving conversation {filename}: {e}")
 
-def create_initial_prompt(request, chat_history):
-    history_text = "\n".join([f"{entry['role']}: {entry['content']}" for entry in chat_history])
+def delete_conversation(filename):
+    conversation_index.remove(filename)
+    history_cache.discard(filename)
+    context_path = ConversationContext.path_for(filename)
+    if os.path.exists(context_path):
+        os.remove(context_path)
+    if STORAGE_BACKEND == "sqlite":
+        get_sqlite_store().delete(filename)
+        return
+    get_journal(filename).delete()
+    with _journals_lock:
+        _journals.pop(filename, None)
+
+# Returns (filename, message position, role, snippet) for messages containing the query. The
+# JSON backend has no index, so it falls back to scanning every conversation.
+# Without SQLite every conversation is read, so the scan stops early once `token` is cancelled.
+def search_conversations(query, limit=SEARCH_RESULT_LIMIT, token=None):
+    if STORAGE_BACKEND == "sqlite":
+        return get_sqlite_store().search(query, limit)
+    results = []
+    needle = query.lower()
+    for filename in list_conversations():
+        if token is not None and token.cancelled:
+            break
+        for position, entry in enumerate(load_conversation(filename)):
+            content = str(entry.get("content", ""))
+            index = content.lower().find(needle)
+            if index == -1 and needle not in entry.get("role", "").lower():
+                continue
+            start = max(0, index - 30)
+            results.append((filename, position, entry.get("role", ""), content[start:start + 80]))
+            if len(results) >= limit:
+                return results
+    return results
+
+# Folds the journal of every stored conversation back into its JSON snapshot. Files written
+# before journaling existed are plain snapshots and are loaded as they are.
+def migrate_conversations():
+    for filename in os.listdir(CONVERSATION_DIR):
+        if filename.endswith(".json"):
+            try:
+                journal = get_journal(filename)
+                journal.compact(journal.load())
+            except Exception as e:
+                print(f"Error compacting conversation {filename}: {e}")
+
+# Returns (format, compressed) for an export path; unknown extensions export as text.
+def export_format(path):
+    compressed = path.lower().endswith(".gz")
+    extension = os.path.splitext(path[:-3] if compressed else path)[1].lower()
+    return EXPORT_FORMATS.get(extension, "text"), compressed
+
+def export_lines(chat_history, style, title):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if style == "markdown":
+        yield f"# {title}\n\n_Exported {timestamp}, {len(chat_history)} messages_\n\n"
+    elif style == "text":
+        yield (f"CodeCollab AI Conversation Export\n{'=' * 40}\nDate: {timestamp}\n"
+               f"Total messages: {len(chat_history)}\n{'=' * 40}\n\n")
+    for i, entry in enumerate(chat_history, 1):
+        if style == "jsonl":
+            yield json.dumps(entry) + "\n"
+            continue
+        role = entry.get("role", "Unknown")
+        content = str(entry.get("content", "")).replace("\r\n", "\n").replace("\r", "\n")
+        if style == "markdown":
+            # Content is written as is, so code fences in answers stay code blocks.
+            yield f"### {ROLE_TAGS.get(role, ('', role))[1]}\n\n{content}\n\n"
+        else:
+            yield f"Message #{i}\nFrom: {role}\nContent:\n{content}\n{'-' * 20}\n\n"
+
+# Writes a conversation to `path` one message at a time and returns the number of messages
+# and characters written.
+def export_conversation(chat_history, path, title="CodeCollab AI Conversation"):
+    style, compressed = export_format(path)
+    messages = len(chat_history)
+    characters = 0
+    tmp_path = path + ".tmp"
+    opener = gzip.open if compressed else open
+    with opener(tmp_path, "wt", encoding="utf-8") as f:
+        for text in export_lines(chat_history, style, title):
+            f.write(text)
+            characters += len(text)
+    os.replace(tmp_path, path)
+    return messages, characters
+
+# Exports every saved conversation into `directory` with the given extension (e.g. ".md.gz"),
+# calling on_progress(done, total) as each one finishes. Returns the names that failed.
+def export_all_conversations(directory, extension, on_progress=None):
+    filenames = list_conversations()
+    failed = []
+
+    def export_one(filename):
+        name = os.path.splitext(filename)[0]
+        export_conversation(load_conversation(filename), os.path.join(directory, name + extension), name)
+
+    with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+        futures = {executor.submit(export_one, filename): filename for filename in filenames}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error exporting conversation {futures[future]}: {e}")
+                failed.append(futures[future])
+            if on_progress:
+                on_progress(done, len(filenames))
+    return failed
+
+# Keeps the rolling summary of the turns that no longer fit in prompts verbatim. It is stored
+# in <name>.context next to the conversation, so reopening a long chat does not re-summarize.
+class ConversationContext:
+    def __init__(self, filename=None):
+        self.path = self.path_for(filename) if filename else None
+        self.lock = threading.Lock()
+        self.summary = ""
+        self.covered = 0
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+                self.summary = data["summary"]
+                self.covered = data["covered"]
+            except Exception as e:
+                print(f"Error loading conversation summary {self.path}: {e}")
+
+    @staticmethod
+    def path_for(filename):
+        return os.path.join(CONVERSATION_DIR, os.path.splitext(filename)[0] + ".context")
+
+    def reset(self):
+        with self.lock:
+            self.summary = ""
+            self.covered = 0
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+
+    # Returns the history text to put in a prompt and its token count. `summarize` is called
+    # with a summary prompt whenever older turns have to be folded into the summary.
+    # Only messages from `covered` on are read, so a HistoryWindow that starts at or before
+    # `covered` is never read back from storage here.
+    def build(self, chat_history, budget, model, summarize, end=None):
+        with self.lock:
+            end = len(chat_history) if end is None else end
+            if self.covered > end:
+                self.summary = ""
+                self.covered = 0
+            if isinstance(chat_history, HistoryWindow) and self.covered < chat_history.offset:
+                # Messages that are no longer in memory are read back once and folded into
+                # the summary, so later builds only touch the window.
+                offset = chat_history.offset
+                try:
+                    self.summary = fold_into_summary(self.summary, chat_history[self.covered:offset],
+                                                     summarize, model)
+                except GenerationCancelled:
+                    raise
+                except Exception as e:
+                    print(f"Error summarizing conversation history, dropping {offset - self.covered} old messages: {e}")
+                self.covered = offset
+                self.persist()
+            tail = chat_history[self.covered:end]
+            tail_tokens = history_tokens(tail, model)
+            summary_tokens = count_tokens(self.summary, model) if self.summary else 0
+
+            if tail_tokens + summary_tokens > budget and len(tail) > 1:
+                target = budget * HISTORY_KEEP_RATIO - SUMMARY_MAX_WORDS * 2
+                fold = 0
+                while fold < len(tail) - 1 and tail_tokens > target:
+                    tail_tokens -= entry_tokens(tail[fold], model) + 1
+                    fold += 1
+                try:
+                    self.summary = fold_into_summary(self.summary, tail[:fold], summarize, model)
+                except GenerationCancelled:
+                    raise
+                except Exception as e:
+                    print(f"Error summarizing conversation history, dropping {fold} old messages: {e}")
+                self.covered += fold
+                tail = tail[fold:]
+                summary_tokens = count_tokens(self.summary, model) if self.summary else 0
+                self.persist()
+            if isinstance(chat_history, HistoryWindow):
+                chat_history.trim(self.covered)
+
+            history_text = format_history(tail)
+            if self.summary:
+                history_text = f"(Summary of the earlier conversation: {self.summary})\n{history_text}"
+            return history_text, tail_tokens + summary_tokens
+
+    def persist(self):
+        if not self.path:
+            return
+        try:
+            atomic_write_json(self.path, {"covered": self.covered, "summary": self.summary})
+        except Exception as e:
+            print(f"Error saving conversation summary {self.path}: {e}")
+
+class SummaryCache:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def _load(self):
+        if self.entries is None:
+            self.entries = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, "r") as f:
+                        self.entries = json.load(f)
+                except Exception as e:
+                    print(f"Error loading summary cache {self.path}: {e}")
+
+    def get(self, key):
+        with self.lock:
+            self._load()
+            return self.entries.get(key)
+
+    def put(self, key, summary):
+        with self.lock:
+            self._load()
+            self.entries[key] = summary
+            while len(self.entries) > SUMMARY_CACHE_SIZE:
+                del self.entries[next(iter(self.entries))]
+            try:
+                atomic_write_json(self.path, self.entries)
+            except Exception as e:
+                print(f"Error saving summary cache {self.path}: {e}")
+
+summary_cache = SummaryCache(os.path.join(CACHE_DIR, "summaries.json"))
+
+def split_into_chunks(text, max_tokens, model=None):
+    pieces = []
+    for block in re.split(r"(```.*?```)", text, flags=re.S):
+        if block.startswith("```"):
+            pieces.append(block)
+        else:
+            pieces.extend(piece for piece in block.split("\n\n") if piece.strip())
+
+    chunks, current, current_tokens = [], [], 0
+    for piece in pieces:
+        tokens = count_tokens(piece, model)
+        if tokens > max_tokens:
+            step = max(1, len(piece) * max_tokens // tokens)
+            parts = [piece[i:i + step] for i in range(0, len(piece), step)]
+        else:
+            parts = [piece]
+        for part in parts:
+            part_tokens = tokens if len(parts) == 1 else count_tokens(part, model)
+            if current and current_tokens + part_tokens > max_tokens:
+                chunks.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            current.append(part)
+            current_tokens += part_tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+# Condenses text to about max_words words with `summarize` (a prompt -> text callable).
+# Long text is summarized per chunk and the joined partial summaries are condensed again.
+def compress_text(text, summarize, model=None, max_words=SUMMARY_MAX_WORDS):
+    if count_tokens(text, model) <= max_words * 2:
+        return text
+    key = hashlib.sha256(f"{max_words}\0{text}".encode("utf-8")).hexdigest()
+    cached = summary_cache.get(key)
+    if cached is not None:
+        return cached
+
+    chunks = split_into_chunks(text, SUMMARY_CHUNK_TOKENS, model)
+    if len(chunks) == 1:
+        summary = summarize(create_compress_prompt(text, max_words)).strip()
+    else:
+        chunk_words = max(50, max_words // len(chunks) * 2)
+        partials = [summarize(create_compress_prompt(chunk, chunk_words)).strip() for chunk in chunks]
+        summary = compress_text("\n\n".join(partials), summarize, model, max_words)
+    summary_cache.put(key, summary)
+    return summary
+
+def format_history(chat_history):
+    return "\n".join([f"{entry['role']}: {entry['content']}" for entry in chat_history])
+
+def create_summary_prompt(previous_summary, entries):
+    history_text = "\n".join([f"{entry['role']}: {str(entry['content'])[:SUMMARY_ENTRY_CHARS]}" for entry in entries])
+    previous_text = f"Summary of the conversation before these messages:\n\n{previous_summary}\n\n" if previous_summary else ""
+    return f"""You are keeping notes on a programming conversation so older messages can be dropped.
+
+{previous_text}Messages to add to the summary:
+
+{history_text}
+
+Write an updated summary of the whole conversation in at most {SUMMARY_MAX_WORDS} words. Keep:
+- The programmer's goals and requirements.
+- Decisions made and solutions accepted or rejected.
+- Names, signatures and short snippets of code that later messages may refer to.
+- Open problems still being worked on.
+Reply with the summary only.
+"""
+
+# Adds `entries` to `summary` a batch at a time, so no summary prompt is larger than
+# SUMMARY_CHUNK_TOKENS of messages (or half the model's context window, if that is smaller).
+def fold_into_summary(summary, entries, summarize, model=None):
+    limit = min(SUMMARY_CHUNK_TOKENS, context_window(model) // 2)
+    batch, batch_tokens = [], 0
+    for entry in entries:
+        content = str(entry["content"])
+        if len(content) > SUMMARY_ENTRY_CHARS:
+            tokens = count_tokens(content[:SUMMARY_ENTRY_CHARS], model)
+        else:
+            tokens = entry_tokens(entry, model)
+        if batch and batch_tokens + tokens > limit:
+            summary = summarize(create_summary_prompt(summary, batch)).strip()
+            batch, batch_tokens = [], 0
+        batch.append(entry)
+        batch_tokens += tokens + 1
+    if batch:
+        summary = summarize(create_summary_prompt(summary, batch)).strip()
+    return summary
+
+def create_compress_prompt(text, max_words):
+    return f"""Condense the following answer to a programming request into at most {max_words} words.
+- Keep the code the answer depends on inside triple backticks, trimmed to the lines that matter.
+- Keep the key explanation and any caveats.
+- Reply with the condensed answer only.
+
+{text}
+"""
+
+def create_initial_prompt(request, chat_history, history_text=None):
+    if history_text is None:
+        history_text = format_history(chat_history)
     return f"""Here is the conversation history so far:
 
 {history_text}
@@ -56,8 +2086,16 @@ Your task is to understand the programmer's goal and provide a helpful response.
 Please interpret their request and respond with a solution that meets their goal.
 """
 
-def create_helper_prompt(request, main_response, chat_history, feedback_description=""):
-    history_text = "\n".join([f"{entry['role']}: {entry['content']}" for entry in chat_history])
+# Whether a feedback description tells the helpers more than a plain "it's wrong", in which
+# case helper answers prepared before it was given are asked again.
+def feedback_is_material(description):
+    words = [word for word in re.findall(r"[a-z0-9_]+", description.lower().replace("'", ""))
+             if word not in GENERIC_FEEDBACK_WORDS]
+    return len(words) >= SPECULATION_MATERIAL_WORDS
+
+def create_helper_prompt(request, main_response, chat_history, feedback_description="", history_text=None):
+    if history_text is None:
+        history_text = format_history(chat_history)
     feedback_text = f"The programmer said: {feedback_description}" if feedback_description else "The programmer didn't provide specific feedback."
     return f"""We're in a group discussion to help a programmer. Here's the conversation so far:
 
@@ -78,8 +2116,9 @@ Can you suggest a better solution? Please:
 - Focus on accurately addressing the programmer's goal.
 """
 
-def create_improved_prompt(request, chat_history, latest_main_response, helper1_response, helper2_response, feedback_description=""):
-    history_text = "\n".join([f"{entry['role']}: {entry['content']}" for entry in chat_history])
+def create_improved_prompt(request, chat_history, latest_main_response, helper1_response, helper2_response, feedback_description="", history_text=None):
+    if history_text is None:
+        history_text = format_history(chat_history)
     feedback_text = f"The programmer said: {feedback_description}" if feedback_description else "The programmer didn't provide specific feedback."
     return f"""We're working together to solve the programmer's request. Here's the conversation history:
 
@@ -110,6 +2149,676 @@ Now, it’s my turn again. Using the helpers’ suggestions and the history:
 - Correct any mistakes from my previous attempt.
 """
 
+class EngineListener:
+    def history_changed(self, engine):
+        pass
+
+    def stream_started(self, engine, role):
+        pass
+
+    def stream_chunk(self, engine, role, chunk):
+        pass
+
+    def stream_finished(self, engine, role):
+        pass
+
+    def turn_finished(self, engine):
+        pass
+
+    def metrics_updated(self, engine, metrics):
+        pass
+
+    def progress_changed(self, engine):
+        pass
+
+    # A message for the programmer that is not part of the conversation.
+    def notice(self, engine, text):
+        pass
+
+
+# Helper answers requested in the background, at low priority, while the programmer reads
+# the main answer. `responses` fills in as the helpers finish.
+class HelperSpeculation:
+    def __init__(self, engine):
+        self.engine = engine
+        self.models = (engine.helper1_model, engine.helper2_model)
+        self.token = CancelToken()
+        self.priority = Priority()
+        self.responses = {}
+        self.done = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        engine = self.engine
+        try:
+            history_text, _ = engine.build_history(token=self.token, low_priority=self.priority)
+            prompt = create_helper_prompt(engine.latest_request, engine.latest_main_response,
+                                          engine.chat_history, "", history_text)
+            for role, response, metrics in engine.run_helpers(prompt, token=self.token,
+                                                              low_priority=self.priority, stream=False):
+                self.responses[role] = (response, dict(metrics, speculative=True))
+        except GenerationCancelled:
+            pass
+        except Exception as e:
+            print(f"Error preparing helper answers in the background: {e}")
+        finally:
+            self.done.set()
+
+    def cancel(self):
+        self.token.cancel()
+
+    # Waits for the helpers still running, giving up when `token` (the round's) is cancelled.
+    # The round now depends on them, so calls still queued stop giving way to other chats.
+    def wait(self, token):
+        self.priority.low = False
+        while not self.done.wait(CANCEL_POLL_INTERVAL):
+            if token.cancelled:
+                self.cancel()
+                raise GenerationCancelled("Generation cancelled.")
+        return self.responses
+
+# Drives the main developer / helpers / improved answer loop for one conversation without
+# any UI. Blocking model calls run in worker threads, so the async methods can be awaited
+# from any asyncio loop. A listener (see EngineListener) is told about new messages and,
+# when streaming, about each chunk as it arrives.
+class CollabEngine:
+    def __init__(self, filename=None, main_model=None, helper1_model=None, helper2_model=None,
+                 model_pool=None, listener=None, stream=False, scheduler=None, speculative=None,
+                 chat_history=None):
+        models = get_available_models()
+        self.filename = filename
+        self.main_model = main_model or models[0]
+        self.helper1_model = helper1_model or (models[1] if len(models) > 1 else models[0])
+        self.helper2_model = helper2_model or (models[2] if len(models) > 2 else models[0])
+        self.model_pool = model_pool or ModelPool()
+        self.listener = listener or EngineListener()
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.streams = {}
+        self.call_metrics = {}
+        self.cancel_token = CancelToken()
+        self.deadlines = {}
+        self.interrupted = None
+        self.scheduler = scheduler or request_scheduler
+        self.activity = {}
+        self.busy = False
+        self.speculative = SPECULATIVE_HELPERS if speculative is None else speculative
+        self.speculation = None
+        self.context = ConversationContext(filename)
+        if chat_history is None:
+            chat_history = load_conversation_tail(filename, keep_from=self.context.covered) if filename else []
+        self.chat_history = chat_history
+        self.state = self.infer_state()
+        self.latest_request, self.latest_main_response = self.recover_round()
+        self.helper1_response = None
+        self.helper2_response = None
+        self.feedback_description = ""
+        self.main_llm = None
+        self.helper1_llm = None
+        self.helper2_llm = None
+
+    def infer_state(self):
+        if self.chat_history:
+            last_entry = self.chat_history[-1]
+            if last_entry["role"] == "System" and "Was this response helpful?" in last_entry["content"]:
+                return "awaiting_feedback"
+            elif last_entry["role"] == "System" and "Please describe what went wrong" in last_entry["content"]:
+                return "awaiting_description"
+        return "initial"
+
+    # A conversation reopened while waiting for feedback picks up the request and the answer
+    # being rated from its last messages, so a "no" still has something to improve on.
+    def recover_round(self):
+        if self.state == "initial":
+            return None, None
+        request = response = None
+        recent = self.chat_history[max(len(self.chat_history) - HISTORY_WINDOW_SIZE, 0):]
+        for entry in reversed(recent):
+            content = entry["content"]
+            if response is None and entry["role"] == "Main Developer":
+                response = content
+            elif response is not None and entry["role"] == "Programmer" and not (
+                    content.startswith(("Was this helpful? ", "Feedback: "))
+                    or content == "No specific feedback provided."):
+                request = content
+                break
+        return request, response
+
+    def set_models(self, main_model, helper1_model, helper2_model):
+        self.main_model = main_model
+        self.helper1_model = helper1_model
+        self.helper2_model = helper2_model
+
+    def append(self, role, content, metrics=None):
+        entry = {"role": role, "content": content}
+        if metrics:
+            entry["metrics"] = metrics
+        self.chat_history.append(entry)
+        self.listener.history_changed(self)
+        self.save()
+
+    def save(self):
+        if self.filename:
+            save_conversation(self.filename, self.chat_history)
+
+    def clear(self):
+        self.cancel_speculation()
+        if self.filename:
+            history_cache.discard(self.filename)
+        self.chat_history = []
+        self.context.reset()
+        self.state = "initial"
+        self.save()
+
+    # Feeds one line of user input through the same yes/no state machine as the chat window.
+    async def handle_input(self, user_input):
+        if self.busy:
+            self.listener.notice(self, "Still working on the last message. Wait for it or press Cancel.")
+            return None
+        if self.state == "initial":
+            return await self.submit_request(user_input)
+        elif self.state == "awaiting_feedback":
+            if user_input in ["yes", "no"]:
+                await self.answer_feedback(user_input == "yes")
+            else:
+                self.chat_history.append({"role": "System", "content": "Please respond with 'yes' or 'no'."})
+                self.listener.history_changed(self)
+        elif self.state == "awaiting_description":
+            return await self.describe_problem(user_input)
+
+    async def submit_request(self, request):
+        self.cancel_speculation()
+        self.latest_request = request
+        self.append("Programmer", self.latest_request)
+        self.state = "awaiting_feedback"
+        self.start_round()
+        try:
+            await asyncio.to_thread(self.generate_initial_response)
+        except GenerationCancelled as e:
+            self.interrupted = str(e)
+            self.state = "initial"
+            self.append("System", f"{e} Send the request again to retry.")
+            self.listener.turn_finished(self)
+            return None
+        except Exception as e:
+            print(f"Error generating a response: {type(e).__name__}: {e}")
+            self.interrupted = f"{type(e).__name__}: {e}"
+            self.state = "initial"
+            self.append("System", f"Could not get an answer ({e}). Send the request again to retry.")
+            self.listener.turn_finished(self)
+            return None
+        finally:
+            self.end_round()
+        return self.latest_main_response
+
+    async def answer_feedback(self, helpful):
+        self.append("Programmer", f"Was this helpful? {'yes' if helpful else 'no'}")
+        if helpful:
+            self.cancel_speculation()
+            self.append("Main Developer", "Awesome! Glad we got it right.")
+            self.state = "initial"
+        else:
+            self.append("System", "Please describe what went wrong or what you expected.")
+            self.state = "awaiting_description"
+
+    async def describe_problem(self, description):
+        self.feedback_description = description if description else ""
+        if self.feedback_description:
+            self.append("Programmer", f"Feedback: {self.feedback_description}")
+        else:
+            self.append("Programmer", "No specific feedback provided.")
+        self.state = "awaiting_feedback"
+        self.start_round()
+        try:
+            await asyncio.to_thread(self.consult_helpers)
+        except GenerationCancelled as e:
+            self.interrupted = str(e)
+            self.append("System", f"{e} Was this response helpful? (yes/no)")
+            self.listener.turn_finished(self)
+            return None
+        except Exception as e:
+            print(f"Error generating an improved response: {type(e).__name__}: {e}")
+            self.interrupted = f"{type(e).__name__}: {e}"
+            self.append("System", f"Could not get an improved answer ({e}). Was this response helpful? (yes/no)")
+            self.listener.turn_finished(self)
+            return None
+        finally:
+            self.end_round()
+        return self.latest_main_response
+
+    def start_round(self):
+        self.cancel_token = CancelToken()
+        self.interrupted = None
+        self.busy = True
+        self.listener.progress_changed(self)
+
+    def end_round(self):
+        self.busy = False
+        self.listener.progress_changed(self)
+
+    # Aborts the model calls of the current round; the round ends with a System message.
+    def cancel(self):
+        self.cancel_token.cancel()
+        self.cancel_speculation()
+
+    def cancel_speculation(self):
+        if self.speculation is not None:
+            self.speculation.cancel()
+            self.speculation = None
+
+    def start_speculation(self):
+        self.cancel_speculation()
+        if self.speculative:
+            self.speculation = HelperSpeculation(self)
+
+    # Stops writing to the conversation file, e.g. once it has been deleted, and cancels the round.
+    def detach(self):
+        self.filename = None
+        self.cancel()
+
+    # Brings the deadline of a running call forward, e.g. once the other helper has answered.
+    def shorten_deadline(self, role, seconds):
+        with self.lock:
+            deadline = self.deadlines.get(role)
+            if deadline is not None:
+                limit = time.monotonic() + seconds
+                deadline[0] = limit if deadline[0] is None else min(deadline[0], limit)
+
+    # Answers the latest request with yes/no feedback in one call. Returns the improved
+    # answer, or None when the first answer was helpful.
+    async def give_feedback(self, helpful, description=""):
+        await self.answer_feedback(helpful)
+        if helpful:
+            return None
+        return await self.describe_problem(description)
+
+    # Waits for a slot from the shared scheduler, then runs one model call under the round's
+    # cancel token and the role's deadline, and records its CallMetrics in metrics_log and
+    # self.call_metrics. The slot is held until the request to Ollama has ended, even when the
+    # round gives up on it earlier.
+    def generate(self, llm, prompt, role, stream=None, token=None, low_priority=False):
+        token = token or self.cancel_token
+        if token.cancelled:
+            raise GenerationCancelled("Generation cancelled.")
+        self.set_activity(role, "queued")
+        queued = time.monotonic()
+        try:
+            self.scheduler.acquire(token, low_priority)
+        except GenerationCancelled:
+            self.set_activity(role, None)
+            raise
+        self.set_activity(role, "running")
+        finished = threading.Event()
+        try:
+            return self._generate(llm, prompt, role, stream, token, time.monotonic() - queued, finished)
+        finally:
+            self.scheduler.release_when(finished)
+            self.set_activity(role, None)
+
+    def _generate(self, llm, prompt, role, stream, token, queue_wait, finished):
+        stream = self.stream if stream is None else stream
+        seconds = ROLE_DEADLINES.get(role)
+        deadline = [time.monotonic() + seconds if seconds is not None else None]
+        try:
+            metrics = CallMetrics(llm.model, role, prompt)
+            options = generation_options(llm.model, role, metrics.prompt_tokens)
+            abort = RequestAbort()
+            chunks = iterate_until(llm.stream(prompt, config={"callbacks": [metrics], "abort": abort},
+                                              options=options),
+                                   token, lambda: deadline[0], role, abort, finished)
+        except BaseException:
+            finished.set()
+            raise
+        with self.lock:
+            self.deadlines[role] = deadline
+        response = ""
+        if stream:
+            with self.lock:
+                self.streams[role] = ""
+            self.listener.stream_started(self, role)
+        try:
+            for chunk in chunks:
+                metrics.mark_token()
+                response += chunk
+                if stream:
+                    with self.lock:
+                        self.streams[role] += chunk
+                    self.listener.stream_chunk(self, role, chunk)
+            return response
+        except Exception as e:
+            metrics.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            chunks.close()
+            if stream:
+                with self.lock:
+                    self.streams.pop(role, None)
+                self.listener.stream_finished(self, role)
+            result = metrics.finish(response)
+            result["queue_wait"] = round(queue_wait, 3)
+            result["num_ctx"] = options["num_ctx"]
+            metrics_log.add(result)
+            with self.lock:
+                if self.deadlines.get(role) is deadline:
+                    del self.deadlines[role]
+                self.call_metrics[role] = result
+            self.listener.metrics_updated(self, result)
+
+    def set_activity(self, role, status):
+        with self.lock:
+            if status is None:
+                self.activity.pop(role, None)
+            else:
+                self.activity[role] = status
+        self.listener.progress_changed(self)
+
+    # Short description of what the current round is doing, or None when the engine is idle.
+    @property
+    def progress(self):
+        with self.lock:
+            running = [role for role, status in self.activity.items() if status == "running"]
+            if running:
+                return ", ".join(running) + " answering"
+            if self.activity:
+                return "waiting for a free model"
+        return "working" if self.busy else None
+
+    def summarize(self, llm, token=None, low_priority=False):
+        return lambda prompt: self.generate(llm, prompt, "Summary", stream=False, token=token,
+                                            low_priority=low_priority)
+
+    # Builds the history text from the messages before `end` (all of them by default).
+    def build_history(self, end=None, token=None, low_priority=False):
+        models = [self.main_model, self.helper1_model, self.helper2_model]
+        budget = int(min(context_window(model) for model in models) * HISTORY_BUDGET_RATIO)
+        return self.context.build(self.chat_history, budget, self.main_model,
+                                  self.summarize(self.main_llm, token, low_priority), end)
+
+    def select_llms(self):
+        self.main_llm = self.model_pool.get(self.main_model)
+        self.helper1_llm = self.model_pool.get(self.helper1_model)
+        self.helper2_llm = self.model_pool.get(self.helper2_model)
+
+    def generate_initial_response(self):
+        self.select_llms()
+        history_text, _ = self.build_history()
+        prompt = create_initial_prompt(self.latest_request, self.chat_history, history_text)
+        self.latest_main_response = self.generate(self.main_llm, prompt, "Main Developer")
+        self.chat_history.append({"role": "Main Developer", "content": self.latest_main_response,
+                                  "metrics": self.call_metrics["Main Developer"]})
+        self.append("System", "Was this response helpful? (yes/no)")
+        self.listener.turn_finished(self)
+        self.start_speculation()
+
+    # Asks the helpers in parallel and yields (role, answer, metrics) as each one finishes.
+    # A helper that misses its deadline does not hold up the others: its answer is None, and
+    # once one helper has answered the rest get at most HELPER_HEDGE_SECONDS more.
+    def run_helpers(self, prompt, roles=("Helper 1", "Helper 2"), token=None, low_priority=False, stream=None):
+        llms = {"Helper 1": self.helper1_llm, "Helper 2": self.helper2_llm}
+
+        def consult(role):
+            try:
+                response = self.generate(llms[role], prompt, role, stream, token, low_priority)
+            except GenerationTimeout:
+                response = None
+            return response, self.call_metrics[role]
+
+        tasks = [(role, lambda role=role: consult(role)) for role in roles]
+        for role, (response, metrics) in run_concurrently(tasks):
+            if response is not None and HELPER_HEDGE_SECONDS is not None:
+                for other in roles:
+                    self.shorten_deadline(other, HELPER_HEDGE_SECONDS)
+            yield role, response, metrics
+
+    def consult_helpers(self):
+        self.select_llms()
+        helpers = [("Helper 1", self.helper1_llm), ("Helper 2", self.helper2_llm)]
+        speculation, self.speculation = self.speculation, None
+        prepared = {}
+        if speculation is not None:
+            if (feedback_is_material(self.feedback_description)
+                    or speculation.models != (self.helper1_model, self.helper2_model)):
+                speculation.cancel()
+            else:
+                prepared = speculation.wait(self.cancel_token)
+
+        responses = {}
+
+        def record(role, response, metrics):
+            responses[role] = response
+            if response is None:
+                self.append(role, f"No answer: timed out after {metrics['duration']:.0f}s.", metrics)
+            else:
+                self.append(role, response, metrics)
+
+        for role, _ in helpers:
+            if role in prepared:
+                record(role, *prepared[role])
+        missing = [role for role, _ in helpers if role not in prepared]
+        if missing:
+            history_text, _ = self.build_history()
+            helper_prompt = create_helper_prompt(self.latest_request, self.latest_main_response,
+                                                 self.chat_history, self.feedback_description, history_text)
+            for role, response, metrics in self.run_helpers(helper_prompt, missing):
+                record(role, response, metrics)
+        self.helper1_response = responses["Helper 1"]
+        self.helper2_response = responses["Helper 2"]
+        answers = {role: response if response is not None else f"({role} timed out and gave no answer.)"
+                   for role, response in responses.items()}
+
+        # The helper answers are passed to the improved prompt on their own, so leave them out
+        # of the history to avoid sending them twice.
+        history_text, history_size = self.build_history(end=len(self.chat_history) - len(helpers))
+        improved_prompt = create_improved_prompt(self.latest_request, self.chat_history,
+                                               self.latest_main_response,
+                                               answers["Helper 1"], answers["Helper 2"],
+                                               self.feedback_description, history_text)
+
+        main_model = self.main_model
+        helper_tokens = {role: count_tokens(answer, main_model) for role, answer in answers.items()}
+        request_prompt = create_improved_prompt(self.latest_request, [],
+                                                self.latest_main_response, "", "",
+                                                self.feedback_description, "")
+        total_tokens = history_size + count_tokens(request_prompt, main_model) + sum(helper_tokens.values())
+        limit = 0.8 * context_window(main_model)
+        if total_tokens > limit:
+            # Split the room left after history and the request between the two helpers,
+            # rounded down to 100 words so retries ask for the same, memoized summary.
+            available = limit - (total_tokens - sum(helper_tokens.values()))
+            max_words = max(100, int(available / len(helpers) / 2) // 100 * 100)
+            helper_models = {"Helper 1": self.helper1_model, "Helper 2": self.helper2_model}
+            tasks = [(role, lambda role=role, llm=llm: compress_text(answers[role], self.summarize(llm),
+                                                                     helper_models[role], max_words))
+                     for role, llm in helpers]
+            summaries = dict(run_concurrently(tasks))
+            helper1_summary = summaries["Helper 1"]
+            helper2_summary = summaries["Helper 2"]
+
+            improved_prompt = create_improved_prompt(self.latest_request, self.chat_history,
+                                                   self.latest_main_response,
+                                                   helper1_summary, helper2_summary,
+                                                   self.feedback_description, history_text)
+
+        self.latest_main_response = self.generate(self.main_llm, improved_prompt, "Main Developer")
+        self.chat_history.append({"role": "Main Developer", "content": self.latest_main_response,
+                                  "metrics": self.call_metrics["Main Developer"]})
+        self.append("System", "Was this response helpful? (yes/no)")
+        self.listener.turn_finished(self)
+        self.start_speculation()
+
+
+# Seconds from STARTUP_STARTED to each of STARTUP_PHASES, printed once all are reached.
+class StartupTimer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+        self.reported = False
+
+    def mark(self, phase):
+        with self.lock:
+            self.times.setdefault(phase, time.perf_counter() - STARTUP_STARTED)
+            if not STARTUP_REPORT or self.reported or any(name not in self.times for name in STARTUP_PHASES):
+                return
+            self.reported = True
+        print("Startup: " + ", ".join(f"{name} {self.times[name]:.3f}s" for name in STARTUP_PHASES))
+
+startup_timer = StartupTimer()
+
+def start_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# Pushes every request in a JSONL file ({"id": ..., "request": ..., "feedback": ...}) through
+# its own engine, at most `concurrency` at a time, and writes one JSON result per line in
+# completion order. Requests with a "feedback" key also run the helpers and the improved answer.
+async def run_batch(input_path, output, concurrency=2, main_model=None, helper1_model=None, helper2_model=None):
+    with open(input_path, "r", encoding="utf-8") as f:
+        items = [json.loads(line) for line in f if line.strip()]
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    model_pool = ModelPool()
+    if model_catalog.stale():
+        await asyncio.to_thread(model_catalog.refresh)
+
+    async def run_one(index, item):
+        async with semaphore:
+            engine = CollabEngine(None, main_model, helper1_model, helper2_model, model_pool=model_pool)
+            result = {"id": item.get("id", index), "request": item["request"]}
+            started = time.monotonic()
+            try:
+                result["response"] = await engine.submit_request(item["request"])
+                if "feedback" in item and not engine.interrupted:
+                    result["improved_response"] = await engine.give_feedback(False, item["feedback"])
+                    result["helper1_response"] = engine.helper1_response
+                    result["helper2_response"] = engine.helper2_response
+                if engine.interrupted:
+                    result["error"] = engine.interrupted
+            except Exception as e:
+                result["error"] = f"{type(e).__name__}: {e}"
+            result["elapsed"] = round(time.monotonic() - started, 3)
+            result["metrics"] = [entry["metrics"] for entry in engine.chat_history if "metrics" in entry]
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            return result
+
+    return await asyncio.gather(*(run_one(index, item) for index, item in enumerate(items)))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="CodeCollab AI")
+    parser.add_argument("--batch", metavar="REQUESTS_JSONL",
+                        help="run the requests in this JSONL file without the UI and print results as JSONL")
+    parser.add_argument("--output", metavar="RESULTS_JSONL", help="write batch results here instead of stdout")
+    parser.add_argument("--concurrency", type=int, default=2, help="requests processed at the same time in batch mode")
+    parser.add_argument("--main-model")
+    parser.add_argument("--helper1-model")
+    parser.add_argument("--helper2-model")
+    parser.add_argument("--endpoint", action="append", metavar="URL",
+                        help="Ollama server to send requests to; repeat to spread requests over several servers")
+    parser.add_argument("--speculative", action="store_true",
+                        help="ask the helpers in the background before the feedback arrives")
+    parser.add_argument("--replay", action="store_true",
+                        help="answer only from the response cache and fail on a cache miss")
+    parser.add_argument("--migrate", action="store_true",
+                        help="fold every conversation's journal into its JSON file and exit")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="print how long each startup phase took")
+    return parser.parse_args(argv)
+
+CODE_BLOCK_PATTERN = re.compile(r"```([\w+#.-]*)[^\n]*\n(.*?)```", re.S)
+
+def load_lexer(language, code):
+    try:
+        from pygments.lexers import get_lexer_by_name, guess_lexer
+        from pygments.util import ClassNotFound
+    except ImportError:
+        return None
+    try:
+        return get_lexer_by_name(language) if language else guess_lexer(code)
+    except ClassNotFound:
+        return None
+
+def highlight_tag(token_type):
+    while token_type is not None:
+        name = str(token_type)[len("Token."):]
+        if name in HIGHLIGHT_COLORS:
+            return "hl_" + name
+        token_type = token_type.parent
+    return None
+
+# Returns (tag, start, end) character spans for the fenced code blocks in `text`: "code" over
+# each block and one hl_* tag per highlighted token. Without Pygments only "code" is returned.
+def code_spans(text):
+    spans = []
+    for match in CODE_BLOCK_PATTERN.finditer(text):
+        language, code = match.group(1), match.group(2)
+        offset = match.start(2)
+        spans.append(("code", offset, match.end(2)))
+        lexer = load_lexer(language, code)
+        if lexer is None:
+            continue
+        position = offset
+        # Pygments keeps leading/trailing whitespace only with these options, so offsets line up.
+        lexer.stripnl = lexer.stripall = False
+        lexer.ensurenl = False
+        for token_type, value in lexer.get_tokens(code):
+            tag = highlight_tag(token_type)
+            if tag and value.strip():
+                spans.append((tag, position, position + len(value)))
+            position += len(value)
+    return spans
+
+# Computes code_spans on a single worker thread and caches them by content hash.
+class Highlighter:
+    def __init__(self, size=HIGHLIGHT_CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.spans = OrderedDict()
+        self.pending = {}
+        self.requests = queue.Queue()
+        self.worker = None
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def cached(self, key):
+        with self.lock:
+            spans = self.spans.get(key)
+            if spans is not None:
+                self.spans.move_to_end(key)
+            return spans
+
+    # Calls on_done(spans) from the worker thread once `text` is tokenized. Requests for the
+    # same text while it is queued share one tokenization.
+    def submit(self, key, text, on_done):
+        with self.lock:
+            if key in self.pending:
+                self.pending[key].append(on_done)
+                return
+            self.pending[key] = [on_done]
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, daemon=True)
+                self.worker.start()
+        self.requests.put((key, text))
+
+    def run(self):
+        while True:
+            key, text = self.requests.get()
+            try:
+                spans = code_spans(text)
+            except Exception as e:
+                print(f"Error highlighting code: {e}")
+                spans = []
+            with self.lock:
+                self.spans[key] = spans
+                while len(self.spans) > self.size:
+                    self.spans.popitem(last=False)
+                callbacks = self.pending.pop(key, [])
+            for on_done in callbacks:
+                on_done(spans)
+
+highlighter = Highlighter()
+
 class RoundedButton(ttk.Button):
     def __init__(self, master=None, **kw):
         self.radius      = kw.pop('radius', 10)
@@ -154,7 +2863,7 @@ class RoundedButton(ttk.Button):
         self.configure(style='Rounded.TButton')"""
 
 
-class CodingAssistantApp:
+class CodingAssistantApp(EngineListener):
     def __init__(self, root):
         self.root = root
         self.root.title("CodeCollab AI")
@@ -163,17 +2872,23 @@ class CodingAssistantApp:
 
         self.configure_styles()
 
-        self.chat_history = []
-        self.current_conversation = None
-        self.main_llm = None
-        self.helper1_llm = None
-        self.helper2_llm = None
-        self.state = "initial"
-        self.latest_request = None
-        self.latest_main_response = None
-        self.helper1_response = None
-        self.helper2_response = None
-        self.feedback_description = ""
+        self.live_streams = {}
+        self.finished_streams = set()
+        self.ui_events = queue.Queue()
+        self.rendered_history = None
+        self.rendered_count = 0
+        self.rendered_start = 0
+        self.rendered_end = 0
+        self.loading_older = False
+        self.loading_newer = False
+        self.render_generation = 0
+        self.pending_highlights = deque()
+        self.render_needed = True
+        self.full_render_needed = True
+        self.scroll_to_message = None
+        self.conversation_items = []
+        self.conversation_limit = CONVERSATION_PAGE_SIZE
+        self.pending_conversation = None
 
         self.main_frame = tk.Frame(root, bg="#f5f7fa")
         self.main_frame.pack(fill="both", expand=True, padx=0, pady=0)
@@ -218,6 +2933,16 @@ class CodingAssistantApp:
                                              values=models, style="TCombobox")
         self.helper2_model_menu.pack(fill="x", padx=5, pady=2)
 
+        self.model_status_var = tk.StringVar(value="Loaded: checking...")
+        tk.Label(models_frame, textvariable=self.model_status_var, bg="#ffffff", fg="#636e72",
+                 font=('Helvetica', 8), anchor="w", justify="left", wraplength=220).pack(fill="x", padx=5)
+        self.model_pool = ModelPool()
+        for menu in (self.main_model_menu, self.helper1_model_menu, self.helper2_model_menu):
+            menu.bind("<<ComboboxSelected>>", lambda e: self.warm_models())
+            menu.configure(postcommand=lambda: model_catalog.refresh_async(self.models_discovered))
+        self.root.after(0, self.warm_models)
+        model_catalog.refresh_async(self.models_discovered)
+
         conv_frame = tk.LabelFrame(self.left_sidebar, text="Conversations", bg="#ffffff", fg="#2d3436",
                                   font=('Helvetica', 10, 'bold'), bd=0)
         conv_frame.pack(fill="both", expand=True, padx=10, pady=(0, 10))
@@ -233,6 +2958,13 @@ class CodingAssistantApp:
                                            radius=5, color="#fd79a8", hover_color="#d63031")
         self.delete_chat_btn.pack(side="right", fill="x", expand=True, padx=(2, 0))
 
+        self.search_var = tk.StringVar()
+        self.search_after_id = None
+        self.search_token = CancelToken()
+        search_entry = ttk.Entry(conv_frame, textvariable=self.search_var, font=("Helvetica", 10))
+        search_entry.pack(fill="x", pady=(0, 5))
+        self.search_var.trace_add("write", self.schedule_search)
+
         list_frame = tk.Frame(conv_frame, bg="#ffffff")
         list_frame.pack(fill="both", expand=True)
 
@@ -247,7 +2979,7 @@ class CodingAssistantApp:
         scrollbar.config(command=self.conversation_listbox.yview)
 
         self.conversation_listbox.bind("<<ListboxSelect>>", self.load_conversation)
-        self.update_conversation_list()
+        threading.Thread(target=self.sync_conversation_index, daemon=True).start()
 
         self.chat_frame = tk.Frame(self.main_frame, bg="#f5f7fa", bd=0)
         self.chat_frame.pack(side="left", fill="both", expand=True, padx=0, pady=0)
@@ -269,7 +3001,8 @@ class CodingAssistantApp:
                                   font=("Menlo", 11), borderwidth=0, highlightthickness=0,
                                   padx=15, pady=15, spacing3=5, selectbackground="#a29bfe")
         self.chat_display.pack(side="left", fill="both", expand=True)
-        self.chat_display.config(yscrollcommand=chat_scrollbar.set)
+        self.chat_scrollbar = chat_scrollbar
+        self.chat_display.config(yscrollcommand=self.chat_scrolled)
         chat_scrollbar.config(command=self.chat_display.yview)
 
         self.chat_display.tag_configure("user", foreground="#0984e3", font=("Helvetica", 10, "bold"))
@@ -278,6 +3011,17 @@ class CodingAssistantApp:
         self.chat_display.tag_configure("helper1", foreground="#00b894", font=("Helvetica", 10, "bold"))
         self.chat_display.tag_configure("helper2", foreground="#fd79a8", font=("Helvetica", 10, "bold"))
         self.chat_display.tag_configure("code", font=("Menlo", 10), background="#f1f2f6", foreground="#2d3436")
+        for name, color in HIGHLIGHT_COLORS.items():
+            self.chat_display.tag_configure("hl_" + name, foreground=color)
+        self.chat_display.tag_configure("expand", foreground="#6c5ce7", underline=True)
+        self.chat_display.tag_bind("expand", "<Button-1>", self.expand_message)
+        self.chat_display.tag_bind("expand", "<Enter>", lambda e: self.chat_display.config(cursor="hand2"))
+        self.chat_display.tag_bind("expand", "<Leave>", lambda e: self.chat_display.config(cursor=""))
+        self.chat_display.mark_set("history_end", "1.0")
+
+        self.metrics_var = tk.StringVar(value="")
+        tk.Label(self.chat_frame, textvariable=self.metrics_var, bg="#f5f7fa", fg="#636e72",
+                 font=('Helvetica', 8), anchor="w").pack(fill="x", padx=15)
 
         input_frame = tk.Frame(self.chat_frame, bg="#f5f7fa")
         input_frame.pack(fill="x", padx=15, pady=(5, 15))
@@ -303,6 +3047,11 @@ class CodingAssistantApp:
                                        radius=5, color="#6c5ce7", hover_color="#5649c0")
         self.send_button.pack(pady=(0, 5))
 
+        self.cancel_button = RoundedButton(send_btn_frame, text="Cancel", command=self.cancel_generation,
+                                         radius=5, color="#b2bec3", hover_color="#7f8c8d")
+        self.cancel_button.pack()
+        self.root.bind("<Escape>", lambda e: self.cancel_generation())
+
         self.right_sidebar = tk.Frame(self.main_frame, bg="#ffffff", width=200)
         self.right_sidebar.pack(side="right", fill="y", padx=0, pady=0)
         self.right_sidebar.pack_propagate(False)
@@ -338,6 +3087,23 @@ class CodingAssistantApp:
                                  radius=5, color="#b2bec3", hover_color="#7f8c8d")
         export_btn.pack(fill="x", pady=5)
 
+        export_all_btn = RoundedButton(quick_actions, text="Export All", command=self.export_all_conversations,
+                                     radius=5, color="#b2bec3", hover_color="#7f8c8d")
+        export_all_btn.pack(fill="x", pady=5)
+
+        self.export_status_var = tk.StringVar(value="")
+        tk.Label(quick_actions, textvariable=self.export_status_var, bg="#ffffff", fg="#636e72",
+                 font=('Helvetica', 8), anchor="w").pack(fill="x")
+
+        export_metrics_btn = RoundedButton(quick_actions, text="Export Metrics", command=self.export_metrics,
+                                         radius=5, color="#b2bec3", hover_color="#7f8c8d")
+        export_metrics_btn.pack(fill="x", pady=5)
+
+        self.speculative_var = tk.BooleanVar(value=SPECULATIVE_HELPERS)
+        tk.Checkbutton(quick_actions, text="Ask helpers early", variable=self.speculative_var,
+                       command=self.toggle_speculative, bg="#ffffff", fg="#2d3436", activebackground="#ffffff",
+                       font=("Helvetica", 9), anchor="w").pack(fill="x", pady=5)
+
         tips_frame = tk.LabelFrame(self.right_sidebar, text="Tips", bg="#ffffff", fg="#2d3436",
                                   font=('Helvetica', 10, 'bold'), bd=0)
         tips_frame.pack(fill="both", expand=True, padx=10, pady=(0, 10))
@@ -354,6 +3120,70 @@ class CodingAssistantApp:
 
         tk.Label(self.right_sidebar, bg="#ffffff").pack(fill='both', expand=True)
 
+        self.loop = start_event_loop()
+        self.engines = {}
+        self.engine = self.create_engine()
+        self.process_ui_events()
+        startup_timer.mark("ui_build")
+        self.root.after_idle(self.first_paint)
+
+    # Runs once the window is drawn; only then are LangChain and the Ollama clients loaded.
+    def first_paint(self):
+        startup_timer.mark("first_paint")
+        models = [self.main_model_var.get(), self.helper1_model_var.get(), self.helper2_model_var.get()]
+        threading.Thread(target=self.prepare_clients, args=(models,), daemon=True).start()
+
+    def prepare_clients(self, models):
+        try:
+            for model in models:
+                self.model_pool.get(model)
+        except Exception as e:
+            print(f"Error preparing Ollama clients: {e}")
+        startup_timer.mark("ready_to_send")
+
+    @property
+    def chat_history(self):
+        return self.engine.chat_history
+
+    @property
+    def current_conversation(self):
+        return self.engine.filename
+
+    def create_engine(self, filename=None, chat_history=None):
+        return CollabEngine(filename, self.main_model_var.get(), self.helper1_model_var.get(),
+                            self.helper2_model_var.get(), model_pool=self.model_pool,
+                            listener=self, stream=STREAM_RESPONSES,
+                            speculative=self.speculative_var.get(), chat_history=chat_history)
+
+    # Returns the open engine of a conversation, creating it on first use, so a round running
+    # in the background keeps its state while another chat is shown.
+    def open_engine(self, filename, chat_history=None):
+        engine = self.engines.get(filename)
+        if engine is None:
+            engine = self.engines[filename] = self.create_engine(filename, chat_history)
+        return engine
+
+    def switch_engine(self, engine):
+        # An unnamed chat cannot be reopened, so nothing will use its speculative answers.
+        if self.engine is not engine and not self.engine.filename:
+            self.engine.cancel_speculation()
+        self.engine = engine
+        self.pending_conversation = None
+        # Idle engines of other conversations can be reloaded from disk when needed. Ones waiting
+        # for feedback are kept, along with the helper answers they may be fetching ahead.
+        for filename, other in list(self.engines.items()):
+            if other is not engine and not other.busy and other.state == "initial":
+                other.cancel_speculation()
+                del self.engines[filename]
+                history_cache.put(filename, other.chat_history)
+        if engine.filename:
+            self.engines[engine.filename] = engine
+        # Drop queued events of the previous engine before taking the new one's streams.
+        self.drain_ui_events()
+        with engine.lock:
+            self.live_streams = dict(engine.streams)
+        self.update_chat_display(full=True)
+
     def configure_styles(self):
         style = ttk.Style(self.root)
         style.theme_use('clam')
@@ -400,276 +3230,644 @@ class CodingAssistantApp:
         self.input_entry.delete("1.0", "end")
         self.restore_placeholder(None)
 
-        if self.state == "initial":
-            self.latest_request = user_input
-            self.chat_history.append({"role": "Programmer", "content": self.latest_request})
-            self.update_chat_display()
-            self.save_conversation()
-            threading.Thread(target=self.generate_initial_response).start()
-            self.state = "awaiting_feedback"
-        elif self.state == "awaiting_feedback":
-            if user_input in ["yes", "no"]:
-                self.chat_history.append({"role": "Programmer", "content": f"Was this helpful? {user_input}"})
+        self.engine.set_models(self.main_model_var.get(), self.helper1_model_var.get(),
+                               self.helper2_model_var.get())
+        future = asyncio.run_coroutine_threadsafe(self.engine.handle_input(user_input), self.loop)
+        future.add_done_callback(self.report_engine_error)
+
+    def cancel_generation(self):
+        self.engine.cancel()
+
+    def toggle_speculative(self):
+        for engine in {self.engine, *self.engines.values()}:
+            engine.speculative = self.speculative_var.get()
+            if not engine.speculative:
+                engine.cancel_speculation()
+
+    def report_engine_error(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            e = future.exception()
+            print("".join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+    # Main thread only; the redraw happens on the next pass of process_ui_events.
+    def update_chat_display(self, full=False):
+        if full:
+            self.full_render_needed = True
+        self.render_needed = True
+
+    # Called from any thread. Tk widgets are only touched when the main loop applies the event.
+    def post_ui_event(self, kind, engine=None, *args):
+        self.ui_events.put((kind, engine, args))
+
+    def process_ui_events(self):
+        try:
+            self.drain_ui_events()
+            if self.render_needed:
+                self.render_chat_display()
+            self.apply_highlights()
+        except Exception as e:
+            print(f"Error updating the chat window: {e}")
+        self.root.after(RENDER_DELAY_MS, self.process_ui_events)
+
+    # Applies up to UI_EVENTS_PER_BATCH queued events, merging consecutive chunks of the same
+    # stream into one insert. Any other event names a StringVar to set; only its latest value is kept.
+    def drain_ui_events(self):
+        events = []
+        try:
+            while len(events) < UI_EVENTS_PER_BATCH:
+                events.append(self.ui_events.get_nowait())
+        except queue.Empty:
+            pass
+
+        merged = []
+        for kind, engine, args in events:
+            if engine is not None and engine is not self.engine:
+                continue
+            if kind == "chunk" and merged and merged[-1][0] == "chunk" and merged[-1][1][0] == args[0]:
+                merged[-1] = ("chunk", (args[0], merged[-1][1][1] + args[1]))
+            else:
+                merged.append((kind, args))
+
+        statuses = {}
+        progress = set()
+        for kind, args in merged:
+            if kind == "history":
                 self.update_chat_display()
-                self.save_conversation()
-                if user_input == "yes":
-                    self.chat_history.append({"role": "Main Developer", "content": "Awesome! Glad we got it right."})
-                    self.update_chat_display()
-                    self.save_conversation()
-                    self.state = "initial"
+            elif kind == "stream_started":
+                self.apply_stream_started(*args)
+            elif kind == "chunk":
+                self.apply_stream_chunk(*args)
+            elif kind == "stream_finished":
+                self.apply_stream_finished(*args)
+            elif kind == "progress":
+                progress.add(args[0])
+            elif kind == "models":
+                self.apply_models(*args)
+            elif kind == "search_results":
+                self.apply_search_results(*args)
+            elif kind == "notify":
+                title, text = args
+                if title == "Error":
+                    messagebox.showerror(title, text, parent=self.root)
                 else:
-                    self.chat_history.append({"role": "System", "content": "Please describe what went wrong or what you expected."})
-                    self.update_chat_display()
-                    self.save_conversation()
-                    self.state = "awaiting_description"
+                    messagebox.showinfo(title, text, parent=self.root)
+            elif kind == "highlight":
+                self.pending_highlights.append([*args, 0])
+            elif kind == "older_loaded":
+                self.apply_older_loaded(*args)
+            elif kind == "newer_loaded":
+                self.apply_newer_loaded(*args)
+            elif kind == "conversation_loaded":
+                self.apply_conversation_loaded(*args)
+            elif kind == "conversations":
+                if not self.search_var.get().strip():
+                    self.update_conversation_list()
             else:
-                self.chat_history.append({"role": "System", "content": "Please respond with 'yes' or 'no'."})
-                self.update_chat_display()
-        elif self.state == "awaiting_description":
-            self.feedback_description = user_input if user_input else ""
-            if self.feedback_description:
-                self.chat_history.append({"role": "Programmer", "content": f"Feedback: {self.feedback_description}"})
+                statuses[kind] = args
+        for kind, (text,) in statuses.items():
+            getattr(self, kind).set(text)
+        for filename in progress:
+            self.refresh_conversation_item(filename)
+
+    def render_chat_display(self):
+        self.render_needed = False
+        history = self.chat_history
+        self.chat_display.config(state="normal")
+
+        # A view detached from the tail (see below) goes back to it once the conversation grows.
+        detached = self.rendered_end < self.rendered_count
+        if (self.full_render_needed or history is not self.rendered_history
+                or len(history) < self.rendered_count or detached and len(history) != self.rendered_count):
+            self.chat_display.delete("1.0", tk.END)
+            self.chat_display.mark_set("history_end", "1.0")
+            self.chat_display.mark_unset("search_hit", *[mark for mark in self.chat_display.mark_names()
+                                                         if mark.startswith(("entry_", "content_"))])
+            self.render_generation += 1
+            self.pending_highlights.clear()
+            # Only the tail goes into the widget; older messages are paged in on scroll-up.
+            self.rendered_start = max(len(history) - HISTORY_WINDOW_SIZE, 0)
+            self.rendered_end = len(history)
+            if self.scroll_to_message is not None and self.scroll_to_message < self.rendered_start:
+                # A search hit older than the tail is shown with a page of messages on either
+                # side; newer ones are paged in as the view is scrolled down.
+                self.rendered_start = max(self.scroll_to_message - HISTORY_PAGE_SIZE, 0)
+                self.rendered_end = min(self.scroll_to_message + HISTORY_PAGE_SIZE, len(history))
+            self.insert_history_entries(history[self.rendered_start:self.rendered_end], self.rendered_start)
+            self.loading_older = False
+            self.loading_newer = False
+            self.finished_streams.clear()
+            if self.rendered_end == len(history):
+                for role, text in list(self.live_streams.items()):
+                    self.insert_live_block(role, text)
+            self.rendered_history = history
+            self.full_render_needed = False
+        else:
+            for tag in list(self.finished_streams):
+                self.remove_live_block(tag)
+            if not detached:
+                self.insert_history_entries(history[self.rendered_count:], self.rendered_count)
+                self.rendered_end = len(history)
+
+        self.rendered_count = len(history)
+        self.chat_display.config(state="disabled")
+        if self.scroll_to_message is not None and "search_hit" in self.chat_display.mark_names():
+            self.chat_display.yview("search_hit")
+            self.scroll_to_message = None
+        else:
+            self.chat_display.see(tk.END)
+
+    def insert_history_entries(self, entries, first_position, index="history_end"):
+        for position, entry in enumerate(entries, first_position):
+            if position == self.scroll_to_message:
+                self.chat_display.mark_set("search_hit", self.chat_display.index(index))
+            start = self.chat_display.index(index)
+            tag, role_text = ROLE_TAGS.get(entry["role"], ("", entry["role"]))
+            self.chat_display.insert(index, f"{role_text}\n", tag)
+            # Set once the role line is in, so text later inserted in front of it pushes the mark along.
+            self.chat_display.mark_set(f"entry_{position}", start)
+            content = str(entry["content"])
+            self.highlight_message(position, content[:COLLAPSE_PREVIEW_CHARS]
+                                   if len(content) > COLLAPSE_CHARS else content, index)
+            if len(content) > COLLAPSE_CHARS:
+                self.chat_display.insert(index, content[:COLLAPSE_PREVIEW_CHARS], f"message_{position}")
+                self.chat_display.insert(index, f"\n▸ Show all {len(content):,} characters",
+                                         ("expand", f"message_{position}"))
+                self.chat_display.insert(index, "\n\n")
             else:
-                self.chat_history.append({"role": "Programmer", "content": "No specific feedback provided."})
-            self.update_chat_display()
-            self.save_conversation()
-            threading.Thread(target=self.consult_helpers).start()
-            self.state = "awaiting_feedback"
+                self.chat_display.insert(index, f"{content}\n\n")
 
-    def update_chat_display(self):
+    # Marks where the text of message `position` is about to be inserted at `index` and queues
+    # its code highlighting; spans not cached yet are computed by the highlighter thread.
+    def highlight_message(self, position, text, index):
+        if "```" not in text:
+            return
+        mark = f"content_{position}"
+        self.chat_display.mark_set(mark, index)
+        self.chat_display.mark_gravity(mark, "left")
+        key = highlighter.key(text)
+        spans = highlighter.cached(key)
+        generation = self.render_generation
+        if spans is not None:
+            self.pending_highlights.append([generation, position, spans, 0])
+        else:
+            highlighter.submit(key, text, lambda spans: self.post_ui_event(
+                "highlight", None, generation, position, spans))
+
+    # Adds up to HIGHLIGHT_SPANS_PER_BATCH queued tag spans; the rest wait for the next pass.
+    def apply_highlights(self):
+        budget = HIGHLIGHT_SPANS_PER_BATCH
+        marks = None
+        while self.pending_highlights and budget > 0:
+            item = self.pending_highlights[0]
+            generation, position, spans, done = item
+            if marks is None:
+                marks = set(self.chat_display.mark_names())
+            mark = f"content_{position}"
+            if generation != self.render_generation or mark not in marks:
+                self.pending_highlights.popleft()
+                continue
+            for tag, start, end in spans[done:done + budget]:
+                self.chat_display.tag_add(tag, f"{mark} + {start}c", f"{mark} + {end}c")
+            applied = min(len(spans) - done, budget)
+            budget -= applied
+            item[3] = done + applied
+            if item[3] >= len(spans):
+                self.pending_highlights.popleft()
+
+    # Replaces the preview of a collapsed message with its full text.
+    def expand_message(self, event):
+        clicked = self.chat_display.index(f"@{event.x},{event.y}")
+        for tag in self.chat_display.tag_names(clicked):
+            if tag.startswith("message_"):
+                position = int(tag[len("message_"):])
+                start, end = self.chat_display.tag_ranges(tag)[:2]
+                content = str(self.chat_history[position]["content"])
+                self.chat_display.config(state="normal")
+                self.chat_display.delete(start, end)
+                self.highlight_message(position, content, start)
+                self.chat_display.insert(start, content)
+                self.chat_display.tag_delete(tag)
+                self.chat_display.config(state="disabled")
+                return
+
+    def chat_scrolled(self, first, last):
+        self.chat_scrollbar.set(first, last)
+        if float(first) <= 0.0 and self.rendered_start > 0 and not self.loading_older:
+            self.loading_older = True
+            start = max(self.rendered_start - HISTORY_PAGE_SIZE, 0)
+            threading.Thread(target=self.load_older_worker,
+                             args=(self.engine, self.chat_history, start, self.rendered_start),
+                             daemon=True).start()
+        if float(last) >= 1.0 and self.rendered_end < self.rendered_count and not self.loading_newer:
+            self.loading_newer = True
+            stop = min(self.rendered_end + HISTORY_PAGE_SIZE, self.rendered_count)
+            threading.Thread(target=self.load_newer_worker,
+                             args=(self.engine, self.chat_history, self.rendered_end, stop),
+                             daemon=True).start()
+
+    def load_older_worker(self, engine, history, start, stop):
+        entries = history[start:stop]
+        self.post_ui_event("older_loaded", engine, history, start, entries)
+
+    # Puts a page of older messages above the ones shown, keeping the view where it was.
+    def apply_older_loaded(self, history, start, entries):
+        self.loading_older = False
+        if history is not self.rendered_history or start + len(entries) != self.rendered_start:
+            return
         self.chat_display.config(state="normal")
-        self.chat_display.delete("1.0", tk.END)
-
-        for entry in self.chat_history:
-            tag = ""
-            if entry["role"] == "Programmer":
-                tag = "user"
-                role_text = "You"
-            elif entry["role"] == "Main Developer":
-                tag = "main_dev"
-                role_text = "Main Developer"
-            elif entry["role"] == "Helper 1":
-                tag = "helper1"
-                role_text = "Helper 1"
-            elif entry["role"] == "Helper 2":
-                tag = "helper2"
-                role_text = "Helper 2"
-            elif entry["role"] == "System":
-                tag = "system"
-                role_text = "System"
-            else:
-                tag = ""
-                role_text = entry["role"]
+        self.chat_display.mark_set("view_anchor", "@0,0")
+        self.chat_display.mark_set("older_end", "1.0")
+        self.insert_history_entries(entries, start, "older_end")
+        self.chat_display.mark_unset("older_end")
+        self.rendered_start = start
+        # Streams are shown after the last message, so the bottom stays while one is running.
+        if self.rendered_end - start > HISTORY_WINDOW_SIZE + HISTORY_PAGE_SIZE and not self.live_streams:
+            end = start + HISTORY_WINDOW_SIZE
+            self.chat_display.delete(f"entry_{end}", "history_end")
+            self.forget_entries(end, self.rendered_end)
+            self.rendered_end = end
+        self.chat_display.config(state="disabled")
+        self.chat_display.yview("view_anchor")
 
-            self.chat_display.insert(tk.END, f"{role_text}\n", tag)
-            self.chat_display.insert(tk.END, f"{entry['content']}\n\n")
+    def load_newer_worker(self, engine, history, start, stop):
+        entries = history[start:stop]
+        self.post_ui_event("newer_loaded", engine, history, start, entries)
 
+    # Puts a page of newer messages below the ones shown while the view is away from the tail.
+    def apply_newer_loaded(self, history, start, entries):
+        self.loading_newer = False
+        if history is not self.rendered_history or start != self.rendered_end:
+            return
+        self.chat_display.config(state="normal")
+        self.insert_history_entries(entries, start)
+        self.rendered_end = start + len(entries)
+        if self.rendered_end - self.rendered_start > HISTORY_WINDOW_SIZE + HISTORY_PAGE_SIZE:
+            first = self.rendered_end - HISTORY_WINDOW_SIZE
+            self.chat_display.mark_set("view_anchor", "@0,0")
+            self.chat_display.delete("1.0", f"entry_{first}")
+            self.forget_entries(self.rendered_start, first)
+            self.rendered_start = first
+            self.chat_display.yview("view_anchor")
         self.chat_display.config(state="disabled")
-        self.chat_display.see(tk.END)
 
+    # Unsets the marks of messages start..stop once their text is gone from the widget.
+    def forget_entries(self, start, stop):
+        self.chat_display.mark_unset(*[f"{prefix}_{position}" for position in range(start, stop)
+                                       for prefix in ("entry", "content")])
+
+    def insert_live_block(self, role, text):
+        tag, role_text = ROLE_TAGS.get(role, ("", role))
+        start = self.chat_display.index("end-1c")
+        # Keep history_end in front of the block when the history ends at the bottom of the widget.
+        self.chat_display.mark_gravity("history_end", "left")
+        self.chat_display.insert(tk.END, f"{role_text}\n", tag)
+        self.chat_display.insert(tk.END, text)
+        self.chat_display.mark_set(f"stream_{tag}", "end-1c")
+        self.chat_display.insert(tk.END, "\n\n")
+        self.chat_display.mark_gravity("history_end", "right")
+        self.chat_display.mark_set(f"stream_start_{tag}", start)
+
+    def remove_live_block(self, tag):
+        self.chat_display.delete(f"stream_start_{tag}", f"stream_{tag} + 2c")
+        self.chat_display.mark_unset(f"stream_start_{tag}", f"stream_{tag}")
+        self.finished_streams.discard(tag)
+
+    # Lists the conversations from the index, newest first, one page at a time.
     def update_conversation_list(self):
+        self.search_token.cancel()
         self.conversation_listbox.delete(0, tk.END)
-        for filename in os.listdir(CONVERSATION_DIR):
-            if filename.endswith(".json"):
-                self.conversation_listbox.insert(tk.END, filename[:-5])
+        self.conversation_items = []
+        entries, total = conversation_index.page(0, self.conversation_limit)
+        for filename, entry in entries:
+            self.conversation_listbox.insert(tk.END, self.conversation_label(filename))
+            self.conversation_items.append((filename, None))
+        if total > len(entries):
+            self.conversation_listbox.insert(tk.END, f"Show more… ({total - len(entries)} older)")
+            self.conversation_items.append((None, None))
+
+    # Fills the sidebar from the index, then adds conversations missing from it and refreshes.
+    def sync_conversation_index(self):
+        try:
+            conversation_index.load()
+            self.post_ui_event("conversations")
+            conversation_index.sync()
+        except Exception as e:
+            print(f"Error indexing conversations: {e}")
+        self.post_ui_event("conversations")
+
+    def conversation_label(self, filename):
+        engine = self.engines.get(filename)
+        progress = engine.progress if engine is not None else None
+        return f"{filename[:-5]}  ⏳ {progress}" if progress else filename[:-5]
+
+    def refresh_conversation_item(self, filename):
+        selection = self.conversation_listbox.curselection()
+        for index, (item_filename, position) in enumerate(self.conversation_items):
+            if item_filename == filename and position is None:
+                self.conversation_listbox.delete(index)
+                self.conversation_listbox.insert(index, self.conversation_label(filename))
+                if index in selection:
+                    self.conversation_listbox.selection_set(index)
+
+    def schedule_search(self, *args):
+        if self.search_after_id is not None:
+            self.root.after_cancel(self.search_after_id)
+        self.search_after_id = self.root.after(150, self.run_search)
+
+    # Lists the matching conversation names right away; message matches are searched on a
+    # worker thread and appended when they arrive, unless the query has changed by then.
+    def run_search(self):
+        self.search_after_id = None
+        self.search_token.cancel()
+        query = self.search_var.get().strip()
+        if not query:
+            self.update_conversation_list()
+            return
+        self.conversation_listbox.delete(0, tk.END)
+        self.conversation_items = []
+        entries, _ = conversation_index.page(0, None)
+        for filename, entry in entries:
+            if query.lower() in entry["name"].lower():
+                self.conversation_listbox.insert(tk.END, self.conversation_label(filename))
+                self.conversation_items.append((filename, None))
+        self.search_token = CancelToken()
+        threading.Thread(target=self.search_worker, args=(query, self.search_token), daemon=True).start()
+
+    def search_worker(self, query, token):
+        try:
+            results = search_conversations(query, token=token)
+        except Exception as e:
+            print(f"Error searching conversations: {e}")
+            return
+        if not token.cancelled:
+            self.post_ui_event("search_results", None, token, results)
+
+    def apply_search_results(self, token, results):
+        if token is not self.search_token or token.cancelled:
+            return
+        for filename, position, role, snippet in results:
+            snippet = " ".join(snippet.split())
+            self.conversation_listbox.insert(tk.END, f"{filename[:-5]} · {role}: {snippet}")
+            self.conversation_items.append((filename, position))
 
     def new_conversation(self):
         name = simpledialog.askstring("New Chat", "Name your new conversation:", parent=self.root)
         if name:
-            self.current_conversation = name + ".json"
-            self.chat_history = []
-            self.state = "initial"
-            self.update_chat_display()
-            self.save_conversation()
+            previous = self.engines.pop(name + ".json", None)
+            if previous is not None:
+                previous.detach()
+            engine = self.create_engine(name + ".json")
+            engine.clear()
+            self.switch_engine(engine)
             self.update_conversation_list()
 
     def clear_conversation(self):
+        if self.engine.busy:
+            messagebox.showinfo("Info", "Wait for the current answer or press Cancel first.", parent=self.root)
+            return
         if self.current_conversation and messagebox.askyesno("Confirm", "Clear current conversation?", parent=self.root):
-            self.chat_history = []
-            self.state = "initial"
-            self.update_chat_display()
-            if self.current_conversation:
-                save_conversation(self.current_conversation, self.chat_history)
+            self.engine.clear()
+            self.update_chat_display(full=True)
+
+    # Saves the recorded model call metrics as JSON, or as Prometheus text for .prom/.txt files.
+    def export_metrics(self):
+        file_path = tk.filedialog.asksaveasfilename(
+            defaultextension=".json",
+            filetypes=[("JSON", "*.json"), ("Prometheus text", "*.prom"), ("All files", "*.*")],
+            title="Export Metrics"
+        )
+        if not file_path:
+            return
+        try:
+            prometheus = os.path.splitext(file_path)[1].lower() in (".prom", ".txt")
+            with open(file_path, "w", encoding="utf-8") as f:
+                f.write(metrics_log.to_prometheus() if prometheus else metrics_log.to_json())
+            messagebox.showinfo("Success", f"Metrics exported to {file_path}", parent=self.root)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to export metrics: {e}", parent=self.root)
 
     def export_conversation(self):
         if not self.chat_history:
             messagebox.showinfo("Info", "No conversation to export", parent=self.root)
             return
 
-        print(f"Exporting conversation with {len(self.chat_history)} messages")
-        if len(self.chat_history) > 0:
-            first_msg = self.chat_history[0]
-            last_msg = self.chat_history[-1]
-            print(f"First message role: {first_msg.get('role')}, length: {len(str(first_msg.get('content', '')))}")
-            print(f"Last message role: {last_msg.get('role')}, length: {len(str(last_msg.get('content', '')))}")
-
         file_path = tk.filedialog.asksaveasfilename(
             defaultextension=".txt",
-            filetypes=[("Text files", "*.txt"), ("All files", "*.*")],
+            filetypes=[("Text files", "*.txt"), ("Markdown", "*.md"), ("JSON Lines", "*.jsonl"),
+                       ("Compressed", "*.gz"), ("All files", "*.*")],
             title="Export Conversation"
         )
-
         if not file_path:
             return
 
-        try:       
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            content_lines = []
-            content_lines.append("CodeCollab AI Conversation Export")
-            content_lines.append("=" * 40)
-            content_lines.append(f"Date: {timestamp}")
-            content_lines.append(f"Total messages: {len(self.chat_history)}")
-            content_lines.append("=" * 40)
-            content_lines.append("")
-            for i, entry in enumerate(self.chat_history, 1):
-                try:
-                    role = entry.get('role', 'Unknown')
-                    content = entry.get('content', '')
-
-                    if isinstance(content, str):
-                        
-                        content = content.replace("\r\n", "\n").replace("\r", "\n")
-                    else:
-                        content = str(content)
-
-                    content_lines.append(f"Message #{i}")
-                    content_lines.append(f"From: {role}")
-                    content_lines.append("Content:")
-                    content_lines.append(content)
-                    content_lines.append("-" * 20)
-                    content_lines.append("")
-                except Exception as e:
-                    error_msg = f"Error processing message {i}: {str(e)}"
-                    print(error_msg)
-                    content_lines.append(error_msg)
-                    content_lines.append("-" * 20)
-                    content_lines.append("")
-
-            
-            full_content = "\n".join(content_lines)
-
-           
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(full_content)
-
-            
-            with open(file_path, 'r', encoding='utf-8') as f:
-                exported_content = f.read()
-                print(f"Exported file contains {len(exported_content)} characters")
-
-            messagebox.showinfo(
-                "Success",
-                f"Conversation exported successfully!\n\n"
-                f"File: {os.path.basename(file_path)}\n"
-                f"Location: {os.path.dirname(file_path)}\n"
-                f"Total messages: {len(self.chat_history)}",
-                parent=self.root
-            )
+        title = os.path.splitext(self.current_conversation)[0] if self.current_conversation else "CodeCollab AI Conversation"
+        self.export_status_var.set(f"Exporting {os.path.basename(file_path)}...")
+        threading.Thread(target=self.export_worker, args=(self.chat_history, file_path, title), daemon=True).start()
+
+    def export_worker(self, chat_history, file_path, title):
+        try:
+            messages, characters = export_conversation(chat_history, file_path, title)
+            self.post_ui_event("notify", None, "Success",
+                               f"Conversation exported successfully!\n\n"
+                               f"File: {os.path.basename(file_path)}\n"
+                               f"Location: {os.path.dirname(file_path)}\n"
+                               f"Total messages: {messages}\n"
+                               f"Characters: {characters:,}")
         except Exception as e:
-            error_details = f"Failed to export conversation:\n\n{str(e)}"
-            print(error_details)
-            
-            full_error = "".join(traceback.format_exception(type(e), e, e.__traceback__))
-            print(full_error)
-
-            messagebox.showerror(
-                "Error",
-                f"Failed to export conversation:\n\n{str(e)}\n\n"
-                "See console for more details.",
-                parent=self.root
-            )
-
+            print("".join(traceback.format_exception(type(e), e, e.__traceback__)))
+            self.post_ui_event("notify", None, "Error",
+                               f"Failed to export conversation:\n\n{e}\n\nSee console for more details.")
+        self.post_ui_event("export_status_var", None, "")
+
+    # Exports every conversation into a folder in the background, showing progress below the button.
+    def export_all_conversations(self):
+        directory = tk.filedialog.askdirectory(title="Export All Conversations", parent=self.root)
+        if not directory:
+            return
+        extension = simpledialog.askstring(
+            "Export All", "Format: .txt, .md or .jsonl (add .gz to compress)",
+            initialvalue=".md", parent=self.root)
+        if not extension:
+            return
+        extension = "." + extension.strip().lstrip(".")
+        self.export_status_var.set("Exporting conversations...")
+        threading.Thread(target=self.export_all_worker, args=(directory, extension), daemon=True).start()
+
+    def export_all_worker(self, directory, extension):
+        def on_progress(done, total):
+            self.post_ui_event("export_status_var", None, f"Exported {done}/{total} conversations")
+        try:
+            failed = export_all_conversations(directory, extension, on_progress)
+            if failed:
+                self.post_ui_event("notify", None, "Error",
+                                   f"Failed to export {len(failed)} conversations: {', '.join(failed)}")
+            else:
+                self.post_ui_event("notify", None, "Success", f"Conversations exported to {directory}")
+        except Exception as e:
+            self.post_ui_event("notify", None, "Error", f"Failed to export conversations: {e}")
+        self.post_ui_event("export_status_var", None, "")
 
     def load_conversation(self, event):
         selection = self.conversation_listbox.curselection()
         if selection:
-            filename = self.conversation_listbox.get(selection[0]) + ".json"
-            self.current_conversation = filename
-            self.chat_history = load_conversation(filename)
-            if self.chat_history:
-                last_entry = self.chat_history[-1]
-                if last_entry["role"] == "System" and "Was this response helpful?" in last_entry["content"]:
-                    self.state = "awaiting_feedback"
-                elif last_entry["role"] == "System" and "Please describe what went wrong" in last_entry["content"]:
-                    self.state = "awaiting_description"
-                else:
-                    self.state = "initial"
-            else:
-                self.state = "initial"
-            self.update_chat_display()
+            filename, position = self.conversation_items[selection[0]]
+            if filename is None:
+                self.conversation_limit += CONVERSATION_PAGE_SIZE
+                self.update_conversation_list()
+                return
+            self.scroll_to_message = position
+            self.pending_conversation = filename
+            engine = self.engines.get(filename)
+            chat_history = history_cache.get(filename)
+            if engine is not None or chat_history is not None:
+                self.apply_conversation_loaded(filename, chat_history)
+                return
+            threading.Thread(target=self.load_conversation_worker, args=(filename,), daemon=True).start()
+
+    def load_conversation_worker(self, filename):
+        chat_history = load_conversation_tail(filename, keep_from=ConversationContext(filename).covered)
+        history_cache.put(filename, chat_history)
+        self.post_ui_event("conversation_loaded", None, filename, chat_history)
+
+    # Shows a loaded conversation unless another one was picked while it was loading.
+    def apply_conversation_loaded(self, filename, chat_history):
+        if filename != self.pending_conversation:
+            return
+        self.switch_engine(self.open_engine(filename, chat_history))
 
     def delete_conversation(self):
         selection = self.conversation_listbox.curselection()
         if selection:
-            filename = self.conversation_listbox.get(selection[0]) + ".json"
+            filename, _ = self.conversation_items[selection[0]]
+            if filename is None:
+                return
             if messagebox.askyesno("Confirm", "Delete this conversation?", parent=self.root):
                 try:
-                    os.remove(os.path.join(CONVERSATION_DIR, filename))
+                    was_current = self.current_conversation == filename
+                    engine = self.engines.pop(filename, None)
+                    if engine is not None:
+                        engine.detach()
+                    delete_conversation(filename)
                     self.update_conversation_list()
-                    if self.current_conversation == filename:
-                        self.chat_history = []
-                        self.current_conversation = None
-                        self.state = "initial"
-                        self.update_chat_display()
+                    if was_current:
+                        self.switch_engine(self.create_engine())
                 except Exception as e:
                     messagebox.showerror("Error", f"Failed to delete conversation: {e}", parent=self.root)
 
-    def save_conversation(self):
-        if self.current_conversation:
-            save_conversation(self.current_conversation, self.chat_history)
+    def history_changed(self, engine):
+        self.post_ui_event("history", engine)
 
-    def generate_initial_response(self):
-        if not self.main_llm:
-            self.main_llm = OllamaLLM(model=self.main_model_var.get())
-            self.helper1_llm = OllamaLLM(model=self.helper1_model_var.get())
-            self.helper2_llm = OllamaLLM(model=self.helper2_model_var.get())
-        prompt = create_initial_prompt(self.latest_request, self.chat_history)
-        self.latest_main_response = self.main_llm.invoke(prompt)
-        self.chat_history.append({"role": "Main Developer", "content": self.latest_main_response})
-        self.chat_history.append({"role": "System", "content": "Was this response helpful? (yes/no)"})
-        self.update_chat_display()
-        self.save_conversation()
+    def stream_started(self, engine, role):
+        self.post_ui_event("stream_started", engine, role)
 
-    def consult_helpers(self):
-        helper_prompt = create_helper_prompt(self.latest_request, self.latest_main_response,
-                                          self.chat_history, self.feedback_description)
+    def stream_chunk(self, engine, role, chunk):
+        self.post_ui_event("chunk", engine, role, chunk)
 
-        self.helper1_response = self.helper1_llm.invoke(helper_prompt)
-        self.chat_history.append({"role": "Helper 1", "content": self.helper1_response})
-        self.update_chat_display()
-        self.save_conversation()
+    def stream_finished(self, engine, role):
+        self.post_ui_event("stream_finished", engine, role)
 
-        self.helper2_response = self.helper2_llm.invoke(helper_prompt)
-        self.chat_history.append({"role": "Helper 2", "content": self.helper2_response})
-        self.update_chat_display()
-        self.save_conversation()
+    # /api/ps can block for as long as an unreachable server takes to time out, so it is not
+    # asked on the engine's loop or round.
+    def turn_finished(self, engine):
+        threading.Thread(target=self.refresh_model_status, daemon=True).start()
 
-        improved_prompt = create_improved_prompt(self.latest_request, self.chat_history,
-                                               self.latest_main_response,
-                                               self.helper1_response, self.helper2_response,
-                                               self.feedback_description)
-
-        total_tokens = estimate_tokens(improved_prompt)
-        main_model = self.main_model_var.get()
-        if main_model in MODEL_CONTEXT_WINDOWS:
-            context_window = MODEL_CONTEXT_WINDOWS[main_model]
-            if total_tokens > 0.8 * context_window:
-                summary_prompt = "Your previous response was too long. Please provide a concise summary in 2-3 sentences."
-                helper1_summary = self.helper1_llm.invoke(summary_prompt)
-                helper2_summary = self.helper2_llm.invoke(summary_prompt)
-
-                improved_prompt = create_improved_prompt(self.latest_request, self.chat_history,
-                                                       self.latest_main_response,
-                                                       helper1_summary, helper2_summary,
-                                                       self.feedback_description)
-
-        self.latest_main_response = self.main_llm.invoke(improved_prompt)
-        self.chat_history.append({"role": "Main Developer", "content": self.latest_main_response})
-        self.chat_history.append({"role": "System", "content": "Was this response helpful? (yes/no)"})
+    def metrics_updated(self, engine, metrics):
+        self.post_ui_event("metrics_var", engine, format_metrics(metrics))
+
+    def progress_changed(self, engine):
+        if engine.filename:
+            self.post_ui_event("progress", None, engine.filename)
+
+    def notice(self, engine, text):
+        self.post_ui_event("notify", engine, "Info", text)
+
+    def apply_stream_started(self, role):
+        tag, _ = ROLE_TAGS.get(role, ("", role))
+        self.live_streams[role] = ""
+        if self.rendered_end < self.rendered_count:
+            # Back to the tail, where the full render puts the new block.
+            self.scroll_to_message = None
+            self.update_chat_display(full=True)
+            self.render_chat_display()
+            return
+        self.chat_display.config(state="normal")
+        if tag in self.finished_streams:
+            self.remove_live_block(tag)
+        self.insert_live_block(role, "")
+        self.chat_display.config(state="disabled")
+        self.chat_display.see(tk.END)
+
+    def apply_stream_chunk(self, role, chunk):
+        if role not in self.live_streams:
+            return
+        tag, _ = ROLE_TAGS.get(role, ("", role))
+        self.live_streams[role] += chunk
+        self.chat_display.config(state="normal")
+        self.chat_display.insert(f"stream_{tag}", chunk)
+        self.chat_display.config(state="disabled")
+        self.chat_display.see(tk.END)
+
+    def apply_stream_finished(self, role):
+        if role not in self.live_streams:
+            return
+        tag, _ = ROLE_TAGS.get(role, ("", role))
+        self.live_streams.pop(role)
+        self.finished_streams.add(tag)
         self.update_chat_display()
-        self.save_conversation()
+
+    def models_discovered(self, models):
+        self.post_ui_event("models", None, models)
+
+    # Fills the model menus with the installed models. A selection that is not installed is
+    # replaced with the model at the same position in the list.
+    def apply_models(self, models):
+        if not models:
+            return
+        changed = False
+        menus = [(self.main_model_menu, self.main_model_var), (self.helper1_model_menu, self.helper1_model_var),
+                 (self.helper2_model_menu, self.helper2_model_var)]
+        for index, (menu, var) in enumerate(menus):
+            menu.configure(values=models)
+            if var.get() not in models:
+                var.set(models[min(index, len(models) - 1)])
+                changed = True
+        if changed:
+            self.warm_models()
+
+    def warm_models(self):
+        self.model_pool.warm([self.main_model_var.get(), self.helper1_model_var.get(),
+                              self.helper2_model_var.get()], on_done=self.refresh_model_status)
+
+    def refresh_model_status(self):
+        loaded = self.model_pool.loaded_models()
+        self.post_ui_event("model_status_var", None, "Loaded: " + (", ".join(loaded) if loaded else "none"))
+
 
 if __name__ == "__main__":
+    startup_timer.mark("import")
+    args = parse_args()
+    if args.replay:
+        LLM_CACHE_MODE = "replay"
+    if args.endpoint:
+        OLLAMA_ENDPOINTS = args.endpoint
+    if args.speculative:
+        SPECULATIVE_HELPERS = True
+    if args.startup_report:
+        STARTUP_REPORT = True
+    if args.migrate:
+        migrate_conversations()
+        sys.exit(0)
+    if args.batch:
+        output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+        # Keep diagnostics printed along the way out of the JSONL results.
+        sys.stdout = sys.stderr
+        try:
+            results = asyncio.run(run_batch(args.batch, output, args.concurrency, args.main_model,
+                                            args.helper1_model, args.helper2_model))
+        finally:
+            if args.output:
+                output.close()
+        sys.exit(1 if any("error" in result for result in results) else 0)
     root = tk.Tk()
     app = CodingAssistantApp(root)
     root.mainloop()
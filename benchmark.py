@@ -0,0 +1,404 @@
+import os
+import sys
+import math
+import json
+import time
+import random
+import asyncio
+import argparse
+import contextvars
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Stand-in for the Ollama HTTP API. It answers /api/generate with a synthetic reply of
+# `response_tokens` tokens, waits `latency` seconds before the first token (prefill) and then
+# emits `token_rate` tokens per second. Loading a model the server has not seen yet costs
+# `load_delay` seconds, like a cold start on a real server.
+class FakeOllamaServer:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.2, token_rate=200.0, response_tokens=200,
+                 load_delay=0.0, context_length=32768, models=("bench-main", "bench-helper1", "bench-helper2")):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.response_tokens = response_tokens
+        self.load_delay = load_delay
+        self.context_length = context_length
+        self.models = list(models)
+        self.loaded = set()
+        self.lock = threading.Lock()
+        self.requests = []
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _load(self, model):
+        with self.lock:
+            cold = model not in self.loaded
+            self.loaded.add(model)
+        if cold and self.load_delay:
+            time.sleep(self.load_delay)
+        return cold
+
+    def _reply_tokens(self, prompt):
+        rng = random.Random(len(prompt))
+        words = ["def", "return", "value", "items", "result", "the", "list", "for", "in", "if"]
+        tokens = []
+        for i in range(self.response_tokens):
+            if i % 40 == 0:
+                tokens.append("\n```python\n" if i % 80 == 0 else "\n```\n")
+            tokens.append(rng.choice(words) + " ")
+        return tokens
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def read_json(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    self.send_json({"models": [{"name": m, "model": m, "size": 0} for m in server.models]})
+                elif self.path == "/api/ps":
+                    with server.lock:
+                        loaded = sorted(server.loaded)
+                    self.send_json({"models": [{"name": m, "model": m} for m in loaded]})
+                elif self.path == "/api/version":
+                    self.send_json({"version": "0.0.0-fake"})
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                request = self.read_json()
+                if self.path == "/api/show":
+                    self.send_json({"model_info": {"general.architecture": "fake",
+                                                   "fake.context_length": server.context_length}})
+                    return
+                if self.path != "/api/generate":
+                    self.send_error(404)
+                    return
+                model = request.get("model", "")
+                prompt = request.get("prompt") or ""
+                started = time.monotonic()
+                cold = server._load(model)
+                load_duration = time.monotonic() - started
+                if not prompt:
+                    self.send_json({"model": model, "response": "", "done": True,
+                                    "load_duration": int(load_duration * 1e9)})
+                    return
+                with server.lock:
+                    server.requests.append({"model": model, "prompt_chars": len(prompt), "cold": cold,
+                                            "options": request.get("options") or {}})
+
+                time.sleep(server.latency)
+                tokens = server._reply_tokens(prompt)
+                prompt_done = time.monotonic()
+                final = {"model": model, "response": "", "done": True, "done_reason": "stop",
+                         "prompt_eval_count": len(prompt) // 4, "eval_count": len(tokens),
+                         "load_duration": int(load_duration * 1e9),
+                         "prompt_eval_duration": int((prompt_done - started - load_duration) * 1e9)}
+                if request.get("stream", True) is False:
+                    time.sleep(len(tokens) / server.token_rate)
+                    final["response"] = "".join(tokens)
+                    final["eval_duration"] = int(len(tokens) / server.token_rate * 1e9)
+                    final["total_duration"] = int((time.monotonic() - started) * 1e9)
+                    self.send_json(final)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for token in tokens:
+                        time.sleep(1.0 / server.token_rate)
+                        self.write_chunk({"model": model, "response": token, "done": False})
+                    final["eval_duration"] = int((time.monotonic() - prompt_done) * 1e9)
+                    final["total_duration"] = int((time.monotonic() - started) * 1e9)
+                    self.write_chunk(final)
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def write_chunk(self, body):
+                data = (json.dumps(body) + "\n").encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+# Counts bytes the app writes to conversation files (snapshots, journals and their temp
+# files) by shadowing open() inside the app module.
+class WriteCounter:
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def install(self, module):
+        counter = self
+        real_open = open
+
+        class CountingFile:
+            def __init__(self, f):
+                self.f = f
+
+            def write(self, data):
+                with counter.lock:
+                    counter.bytes += len(data.encode("utf-8") if isinstance(data, str) else data)
+                return self.f.write(data)
+
+            def __getattr__(self, name):
+                return getattr(self.f, name)
+
+            def __enter__(self):
+                self.f.__enter__()
+                return self
+
+            def __exit__(self, *exc):
+                return self.f.__exit__(*exc)
+
+            def __iter__(self):
+                return iter(self.f)
+
+        def counting_open(path, mode="r", *args, **kwargs):
+            f = real_open(path, mode, *args, **kwargs)
+            if any(flag in mode for flag in "wa") and os.path.dirname(os.path.abspath(path)) == counter.directory:
+                return CountingFile(f)
+            return f
+
+        module.open = counting_open
+
+
+# Records the token count of every prompt sent to the main model into the list held by
+# current_turn. asyncio.to_thread copies the context, so the engine's worker threads see it.
+current_turn = contextvars.ContextVar("current_turn", default=None)
+
+class RecordingLLM:
+    def __init__(self, app, llm):
+        self.app = app
+        self.llm = llm
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def record(self, prompt):
+        turn = current_turn.get()
+        if turn is not None:
+            turn.append(self.app.count_tokens(prompt))
+
+    def invoke(self, prompt, config=None, options=None):
+        self.record(prompt)
+        return self.llm.invoke(prompt, config=config, options=options)
+
+    def stream(self, prompt, config=None, options=None):
+        self.record(prompt)
+        return self.llm.stream(prompt, config=config, options=options)
+
+
+def recording_pool(app, urls):
+    class RecordingPool(app.ModelPool):
+        def get(self, model):
+            llm = super().get(model)
+            return RecordingLLM(app, llm) if model == "bench-main" else llm
+
+    return RecordingPool(endpoints=urls)
+
+
+class PhaseTimer:
+    def __init__(self, app):
+        self.app = app
+        self.helpers_done = {}
+
+    def listener(self):
+        timer = self
+
+        class Listener(self.app.EngineListener):
+            def history_changed(self, engine):
+                last = engine.chat_history[-1]["role"] if engine.chat_history else None
+                if last in ("Helper 1", "Helper 2"):
+                    timer.helpers_done[id(engine)] = time.monotonic()
+
+        return Listener()
+
+
+async def run_conversations(app, servers, args, timer):
+    model_pool = recording_pool(app, [server.url for server in servers])
+    semaphore = asyncio.Semaphore(max(1, args.concurrency))
+    phases = {"initial": [], "helpers": [], "improved": [], "turn": []}
+    prompt_tokens = [[] for _ in range(args.turns)]
+
+    async def run_one(index):
+        async with semaphore:
+            engine = app.CollabEngine(f"bench-{index}.json", "bench-main", "bench-helper1", "bench-helper2",
+                                      model_pool=model_pool, listener=timer.listener())
+            for turn in range(args.turns):
+                request = f"Turn {turn}: please refactor this function and explain the change.\n" + \
+                          "def f(items):\n    return [x for x in items if x]\n" * args.request_lines
+                prompts = []
+                current_turn.set(prompts)
+                started = time.monotonic()
+                await engine.submit_request(request)
+                initial_done = time.monotonic()
+                phases["initial"].append(initial_done - started)
+                if args.feedback_every and (turn + 1) % args.feedback_every == 0:
+                    await engine.give_feedback(False, "It ignores empty strings, keep them.")
+                    helpers_done = timer.helpers_done.get(id(engine), initial_done)
+                    phases["helpers"].append(helpers_done - initial_done)
+                    phases["improved"].append(time.monotonic() - helpers_done)
+                else:
+                    await engine.give_feedback(True)
+                phases["turn"].append(time.monotonic() - started)
+                prompt_tokens[turn].append(max(prompts, default=0))
+
+    await asyncio.gather(*(run_one(index) for index in range(args.conversations)))
+    return phases, prompt_tokens
+
+
+# Times update_chat_display's render pass when a message is appended to histories of
+# growing length. Needs a display; returns None without one.
+def measure_render(app, server, sizes):
+    try:
+        root = app.tk.Tk()
+    except app.tk.TclError:
+        return None
+    root.withdraw()
+    window = app.CodingAssistantApp(root)
+    window.model_pool = app.ModelPool(base_url=server.url)
+    results = {}
+    message = "Here is the change:\n```python\n" + "def f(items):\n    return items\n" * 20 + "```\n"
+    for size in sizes:
+        engine = app.CollabEngine(None, model_pool=window.model_pool, listener=window)
+        engine.chat_history.extend({"role": "Main Developer", "content": message} for _ in range(size))
+        window.switch_engine(engine)
+        window.render_chat_display()
+        root.update_idletasks()
+        durations = []
+        for _ in range(10):
+            engine.chat_history.append({"role": "Helper 1", "content": message})
+            started = time.perf_counter()
+            window.render_chat_display()
+            root.update_idletasks()
+            durations.append(time.perf_counter() - started)
+        results[size] = sum(durations) / len(durations)
+    root.destroy()
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark CodeCollab AI against a fake Ollama server")
+    parser.add_argument("--conversations", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--concurrency", type=int, default=2, help="conversations running at the same time")
+    parser.add_argument("--feedback-every", type=int, default=2,
+                        help="answer 'no' every N turns to run the helpers (0 never does)")
+    parser.add_argument("--request-lines", type=int, default=5, help="code lines pasted into each request")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="generated tokens per second")
+    parser.add_argument("--response-tokens", type=int, default=200, help="tokens per generated answer")
+    parser.add_argument("--load-delay", type=float, default=0.0, help="seconds to load a cold model")
+    parser.add_argument("--servers", type=int, default=1,
+                        help="fake Ollama servers on separate ports to spread requests over")
+    parser.add_argument("--render-sizes", default="10,100,500",
+                        help="history lengths to time the chat display at (needs a display)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="codecollab-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+
+    app.LLM_CACHE_MODE = "off"
+    servers = [FakeOllamaServer(latency=args.latency, token_rate=args.token_rate,
+                                response_tokens=args.response_tokens, load_delay=args.load_delay).start()
+               for _ in range(max(1, args.servers))]
+    app.model_catalog.refresh([server.url for server in servers])
+    writes = WriteCounter(app.CONVERSATION_DIR)
+    writes.install(app)
+    timer = PhaseTimer(app)
+
+    started = time.monotonic()
+    phases, prompt_tokens = asyncio.run(run_conversations(app, servers, args, timer))
+    wall = time.monotonic() - started
+    app.close_journals()
+    render = measure_render(app, servers[0], [int(size) for size in args.render_sizes.split(",") if size])
+    for server in servers:
+        server.stop()
+
+    ttfts = {}
+    for call in app.metrics_log.recent:
+        if call["ttft"] is not None:
+            ttfts.setdefault(call["role"], []).append(call["ttft"])
+    report = {
+        "wall_seconds": round(wall, 3),
+        "model_requests": sum(len(server.requests) for server in servers),
+        "requests_per_server": [len(server.requests) for server in servers],
+        "latency": {phase: {"p50": round(percentile(values, 0.5), 3), "p95": round(percentile(values, 0.95), 3),
+                            "count": len(values)}
+                    for phase, values in phases.items()},
+        "ttft": {role: {"p50": round(percentile(values, 0.5), 3), "p95": round(percentile(values, 0.95), 3)}
+                 for role, values in ttfts.items()},
+        "main_prompt_tokens_per_turn": [round(sum(values) / len(values)) if values else 0 for values in prompt_tokens],
+        "conversation_bytes_written": writes.bytes,
+        "render_seconds_per_append": {str(size): round(seconds, 5) for size, seconds in render.items()}
+        if render is not None else None,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return report
+
+    print(f"Ran {args.conversations} conversations x {args.turns} turns in {report['wall_seconds']}s "
+          f"({report['model_requests']} model requests)")
+    if len(servers) > 1:
+        print("Requests per server: " + ", ".join(map(str, report["requests_per_server"])))
+    print(f"{'phase':<10}{'p50 (s)':>10}{'p95 (s)':>10}{'count':>8}")
+    for phase, stats in report["latency"].items():
+        print(f"{phase:<10}{stats['p50']:>10}{stats['p95']:>10}{stats['count']:>8}")
+    for role, stats in report["ttft"].items():
+        print(f"Time to first token, {role}: p50 {stats['p50']}s, p95 {stats['p95']}s")
+    print("Largest main model prompt per turn (tokens): " + ", ".join(map(str, report["main_prompt_tokens_per_turn"])))
+    print(f"Bytes written to conversation files: {report['conversation_bytes_written']}")
+    if render is None:
+        print("Chat display render time: skipped (no display available)")
+    else:
+        for size, seconds in report["render_seconds_per_append"].items():
+            print(f"Chat display render with {size} messages: {seconds * 1000:.2f} ms per append")
+    return report
+
+
+if __name__ == "__main__":
+    main()